@@ -0,0 +1,268 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from simulator import SceneRenderer, Vehicle, averageLeft, averageRight
+from processor import ImageProcessor
+from controller import Controller
+from tracker import Tracker, LaneTracker
+from source import openSource
+from line import Line
+from car import Car
+import numpy as np
+import argparse
+import protocol
+import timeit
+import json
+import sys
+import cv2
+import os
+
+# Registered benchmarks as (name, function that receives the fixtures and returns the callable to time).
+BENCHMARKS = []
+
+def benchmark(name):
+    """
+        Decorator for registering a benchmark.
+    """
+    def register(function):
+        BENCHMARKS.append((name, function))
+        return function
+    return register
+
+class Fixtures():
+    """
+        Fixed inputs shared by all benchmarks: a synthetic frame with known lanes, a frame of the
+        recorded drive and random Hough segments.
+    """
+
+    def __init__(self, recording=None):
+        self.processor = ImageProcessor((480, 320), 20)
+        left, right = Vehicle(lateral=0.05).lanes(h=self.processor.h)
+        self.synthetic = SceneRenderer(self.processor, seed=0).render(left, right)
+        self.recorded = None
+        if recording and os.path.exists(recording):
+            source = openSource(recording, self.processor.frameDimensions, self.processor.frameRate).start()
+            self.recorded = source.read()
+            source.stop()
+
+        # Intermediate results of the synthetic frame for the stage benchmarks.
+        p = self.processor
+        self.undistort = cv2.remap(self.synthetic, p.rectifyMapX, p.rectifyMapY, cv2.INTER_LINEAR)
+        self.gray = cv2.cvtColor(self.undistort, cv2.COLOR_BGR2GRAY)
+        self.blured = p.doBlur(self.gray, iterations=3, kernelSize=7)
+        self.canny = cv2.Canny(self.blured, threshold1=20, threshold2=40)
+        self.roi = p.doRegionOfInterest(self.canny)
+        self.grayColor = cv2.cvtColor(self.gray, cv2.COLOR_GRAY2BGR)
+
+        # Edges of a frame with heavy noise, where the Hough transform finds many more segments.
+        clutter = SceneRenderer(p, noise=40, seed=0).render(left, right)
+        gray = cv2.cvtColor(cv2.remap(clutter, p.rectifyMapX, p.rectifyMapY, cv2.INTER_LINEAR), cv2.COLOR_BGR2GRAY)
+        self.clutterCanny = cv2.Canny(p.doBlur(gray, iterations=3, kernelSize=7), threshold1=20, threshold2=40)
+        self.clutterRoi = p.doRegionOfInterest(self.clutterCanny)
+
+        # Random segments inside the ROI with both positive and negative angles.
+        random = np.random.RandomState(0)
+        self.segments = {}
+        for count in (10, 100, 500):
+            x0 = random.randint(0, p.w, count)
+            y0 = random.randint(int(p.h * p.roiY[0]), int(p.h * p.roiY[1]), count)
+            x1 = x0 + random.randint(-40, 40, count)
+            y1 = y0 + random.randint(-20, 20, count)
+            self.segments[count] = np.stack((x0, y0, x1, y1), axis=1).astype(np.int32).reshape(-1, 1, 4)
+
+        # Line with the segments of a typical frame.
+        self.line = Line(p.frameDimensions, (0, 0, 255))
+        self.line.set(self.segments[100].reshape(-1, 4))
+        self.line.fit()
+
+        # Status messages.
+        self.car = Car('/dev/null', 115200)
+        self.statusText = b'5.02,7.41,3.70,3.71,95,90,0\n'
+        self.statusFrame = protocol.pack(protocol.STATUS, 5020, 7410, 3700, 3710, 95, 90, 0)
+
+@benchmark('process.synthetic')
+def benchProcessSynthetic(f):
+    return lambda: f.processor.process(f.synthetic)
+
+@benchmark('process.recorded')
+def benchProcessRecorded(f):
+    if f.recorded is None:
+        return None
+    return lambda: f.processor.process(f.recorded)
+
+# The stages are timed with the calls and the working buffers of process(), so that a stage that
+# allocates again shows up here.
+@benchmark('stage.remap')
+def benchRemap(f):
+    p = f.processor
+    dst = p.getBuffer('undistort', f.synthetic.shape)
+    return lambda: cv2.remap(f.synthetic, p.rectifyMapX, p.rectifyMapY, cv2.INTER_LINEAR, dst=dst)
+
+@benchmark('stage.gray')
+def benchGray(f):
+    p = f.processor
+    gray = p.getBuffer('gray', f.undistort.shape[:2])
+    grayColor = p.getBuffer('output0', f.undistort.shape)
+    return lambda: cv2.cvtColor(cv2.cvtColor(f.undistort, cv2.COLOR_BGR2GRAY, dst=gray), cv2.COLOR_GRAY2BGR, grayColor)
+
+@benchmark('stage.blur')
+def benchBlur(f):
+    p = f.processor
+    dst = p.getBuffer('blured', f.gray.shape)
+    return lambda: p.doBlur(f.gray, iterations=p.blurIterations, kernelSize=p.blurKernelSize, dst=dst)
+
+@benchmark('stage.canny')
+def benchCanny(f):
+    p = f.processor
+    edges = p.getBuffer('canny', f.blured.shape)
+    return lambda: cv2.Canny(f.blured, threshold1=p.cannyThresholds[0], threshold2=p.cannyThresholds[1], edges=edges)
+
+@benchmark('stage.roi')
+def benchRoi(f):
+    p = f.processor
+    dst = p.getBuffer('roi', f.canny.shape)
+    return lambda: p.doRegionOfInterest(f.canny, dst=dst)
+
+@benchmark('stage.hough')
+def benchHough(f):
+    p = f.processor
+    return lambda: cv2.HoughLinesP(f.roi, rho=1, theta=np.pi / 180, threshold=p.houghThreshold, lines=np.array([]), minLineLength=p.houghMinLineLength, maxLineGap=p.houghMaxLineGap)
+
+def benchFindLanes(count):
+    def bench(f):
+        return lambda: f.processor.findLanes(f.grayColor, f.segments[count], minAngle=10)
+    return bench
+
+for count in (10, 100, 500):
+    benchmark('findLanes.%d' % (count))(benchFindLanes(count))
+
+def benchEngine(engine, clutter):
+    def bench(f):
+        processor = ImageProcessor((480, 320), 20, engine=engine)
+        if processor.engine.masked:
+            edges = f.clutterRoi if clutter else f.roi
+        else:
+            edges = f.clutterCanny if clutter else f.canny
+        return lambda: processor.engine.lanes(f.grayColor, processor.engine.search(edges))
+    return bench
+
+for engine in ('hough', 'histogram'):
+    benchmark('engine.%s' % (engine))(benchEngine(engine, False))
+    benchmark('engine.%s.clutter' % (engine))(benchEngine(engine, True))
+
+@benchmark('line.fit')
+def benchLineFit(f):
+    return f.line.fit
+
+@benchmark('line.eval')
+def benchLineEval(f):
+    return lambda: f.line.eval(0.57, 0.71)
+
+# Both lanes, like a LaneTracker.
+@benchmark('tracker.Tracker.add')
+def benchTracker(f):
+    leftTracker, rightTracker = Tracker(), Tracker()
+    return lambda: (leftTracker.add(averageLeft), rightTracker.add(averageRight))
+
+@benchmark('tracker.LaneTracker.add')
+def benchLaneTracker(f):
+    tracker = LaneTracker()
+    return lambda: tracker.add(averageLeft, averageRight)
+
+@benchmark('car.processStatus')
+def benchProcessStatus(f):
+    return lambda: f.car.processStatus(f.statusText)
+
+@benchmark('car.parse.binary')
+def benchParseBinary(f):
+    parser = protocol.FrameParser()
+    return lambda: parser.feed(f.statusFrame)
+
+@benchmark('loop')
+def benchLoop(f):
+    processor = ImageProcessor((480, 320), 20)
+    tracker = LaneTracker()
+    controller = Controller(averageLeft, averageRight, processor.roiY[0] * processor.h)
+    controller.enabled = True
+    def loop():
+        out = processor.process(f.synthetic)
+        left, right = tracker.add(processor.left.poly, processor.right.poly)
+        controller.setLanes(left, right)
+        controller.tick()
+        processor.drawPoly(out, left, (0, 50, 255))
+        processor.drawPoly(out, right, (255, 50, 0))
+        processor.drawPoly(out, averageLeft, (255, 255, 255))
+        processor.drawPoly(out, averageRight, (255, 255, 255))
+    return loop
+
+def measure(function, repeat=5, minTime=0.2):
+    """
+        Times a function and returns the best time per call in us. The number of calls per repetition
+        is chosen so that every repetition takes at least minTime.
+    """
+    timer = timeit.Timer(function)
+    number, elapsed = timer.autorange()
+    number = max(int(number * minTime / max(elapsed, 1e-9)), 1)
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+def run(fixtures, selected=None, repeat=5, minTime=0.2):
+    """
+        Runs the benchmarks whose name starts with any of the selected prefixes. Returns a dictionary
+        with the time per call in us of every benchmark.
+    """
+    results = {}
+    for name, setup in BENCHMARKS:
+        if selected and not any(name.startswith(prefix) for prefix in selected):
+            continue
+        function = setup(fixtures)
+        if function is None:
+            continue
+        results[name] = measure(function, repeat, minTime)
+    return results
+
+def compare(results, baseline, threshold):
+    """
+        Compares the results against the baseline. Returns the names of the benchmarks that are slower
+        than the baseline by more than the threshold.
+    """
+    regressions = []
+    for name, value in results.items():
+        if name in baseline and value > baseline[name] * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+if __name__ == '__main__':
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Benchmarks the hot paths of the lane keeping system.')
+    parser.add_argument('select', nargs='*', help='only run the benchmarks starting with these names')
+    parser.add_argument('--baseline', default=os.path.join(directory, 'benchmarks.json'), help='JSON file with the baseline')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown against the baseline')
+    parser.add_argument('--recording', default=os.path.join(directory, '..', 'images', 'rpi-recording.gif'), help='recorded drive used as input')
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions of every benchmark')
+    args = parser.parse_args()
+
+    results = run(Fixtures(args.recording), args.select, repeat=args.repeat)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    for name, value in results.items():
+        if name in baseline:
+            print('%-28s %10.1f us %+7.1f%%' % (name, value, 100 * (value / baseline[name] - 1)))
+        else:
+            print('%-28s %10.1f us' % (name, value))
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+        print('Baseline saved to %s' % (args.baseline))
+    else:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('Regressions over %.0f%%: %s' % (100 * args.threshold, ', '.join(regressions)))
+            sys.exit(1)
@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import collections
+import numpy as np
+import hashlib
+import os
+
+# Part of every key. Must be increased when a cached stage changes its results.
+VERSION = 1
+
+def makeKey(*parts):
+    """
+        Hashes arrays and plain values into a key. Arrays are hashed by their shape, type and content.
+    """
+
+    key = hashlib.blake2b(str(VERSION).encode('ascii'), digest_size=16)
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            key.update(repr((part.shape, part.dtype.str)).encode('ascii'))
+            key.update(np.ascontiguousarray(part).data)
+        else:
+            key.update(repr(part).encode('ascii'))
+    return key.hexdigest()
+
+class StageCache():
+    """
+        LRU cache of intermediate results of the image processor, e.g. the edges of the ROI band and
+        the result of the lane search. An entry is a dictionary of arrays stored under a key made by
+        makeKey() from the input of the stage and every parameter it depends on, so a changed
+        parameter never hits an old entry. With a directory, the entries evicted from memory are
+        spilled to .npz files there and loaded again on a miss, which shares them between processes
+        and runs; flush() spills the entries still in memory. Entries must not be modified.
+    """
+
+    def __init__(self, size=256, directory=None):
+        self.size = size
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        """
+            Returns the entry of a key or None.
+        """
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        if self.directory:
+            try:
+                with np.load(self.path(key)) as data:
+                    entry = {name: data[name] for name in data.files}
+            except (OSError, ValueError):
+                entry = None
+            if entry is not None:
+                self.diskHits += 1
+                self.add(key, entry)
+                return entry
+        self.misses += 1
+        return None
+
+    def put(self, key, entry):
+        """
+            Stores the entry of a key. The least recently used entry is evicted when the cache is full.
+        """
+        self.add(key, entry)
+
+    def add(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.spill(*self.entries.popitem(last=False))
+
+    def spill(self, key, entry):
+        """
+            Writes an entry to the directory unless it is already there. The file is written under a
+            temporary name and renamed, so that a partial file is never loaded.
+        """
+
+        if not self.directory:
+            return
+        path = self.path(key)
+        if os.path.exists(path):
+            return
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(temporary, 'wb') as f:
+                np.savez(f, **entry)
+            os.replace(temporary, path)
+        except OSError as e:
+            print('Cache entry cant be written: %s' % (e))
+
+    def flush(self):
+        """
+            Spills every entry in memory to the directory.
+        """
+        for key, entry in self.entries.items():
+            self.spill(key, entry)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def stats(self):
+        """
+            Returns the number of hits in memory and on disk and the number of misses.
+        """
+        return {'hits': self.hits, 'diskHits': self.diskHits, 'misses': self.misses}
@@ -1,94 +1,431 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-from queue import Queue
+from profiler import StageProfiler
+import collections
 import threading
-import struct
+import protocol
 import serial
 import time
+import sys
 from os import getpid
 
 class Car(threading.Thread):
     """
         Car class used as an interface between the STM32 micro and the
         RPI. The STM32 controls the motors and reports on the voltage 
-        of the RPI.
+        of the RPI. Commands are sent with the binary protocol when binary
+        is set, otherwise with the text protocol.
+        Only the latest command is kept. If the same command is set again it
+        is not sent. With keepAlive, the last command is repeated every keepAlive
+        seconds so that the STM32 doesn't stop the motors, but only while commands
+        keep being set: once the last setCommand is older than maxCommandAge, a
+        single VEL 0 0 is sent and nothing is repeated until the next command.
+        maxCommandAge must stay below the CONNECTION_TIMEOUT of the STM32.
+        The status is read by a second thread without blocking the commands.
+        With a statusInterval the STM32 pushes the status periodically. The
+        latest status is kept in the status property and passed to onStatus.
+        VEL commands with a stamp carry the sequence number of their frame and
+        are acknowledged by the STM32, which gives the latency from the capture
+        of the frame to the command reaching the motors.
     """
 
-    def __init__(self, serialPort, baudRate, debug=False):
+    def __init__(self, serialPort, baudRate, debug=False, binary=False, keepAlive=None, maxCommandAge=1.5, statusInterval=None, onStatus=None):
         threading.Thread.__init__(self)
         self.debug = debug
         self.serialPort = serialPort
         self.baudRate = baudRate
+        self.binary = binary
+        self.controller = None
+        self.reconnectDelay = (0.1, 5.0)
         self.daemon = True
         self.stop = threading.Event()
         self.requestStatus = threading.Event()
-        self.messageQ = Queue()
-        self.commandQ = Queue()
-        self.buffer = ''
+        self.buffer = b''
+
+        # Status read by the reader thread. When a read fails, readError wakes up the writer, which
+        # reconnects the port.
+        self.parser = protocol.FrameParser()
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.readError = False
+        self.status = None
+        self.statusCount = 0
+        self.onStatus = onStatus
+        self.statusInterval = statusInterval
+        self.subscriptionPending = statusInterval is not None
+
+        # Latest command slot. The writer thread is woken up through the condition.
+        self.condition = threading.Condition()
+        self.keepAlive = keepAlive
+        self.maxCommandAge = maxCommandAge
+        self.lastSetTime = 0
+        self.stale = False
+        self.pendingCommand = None
+        self.pendingStamp = None
+        self.lastCommand = None
+        self.lastSendTime = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+        # Stamps of the commands waiting for their ack by sequence number and the latency of every
+        # step from the capture of a frame to the ack of its command. The writer adds and the reader
+        # removes the commands, so both hold the lock.
+        self.inFlight = collections.OrderedDict()
+        self.inFlightLock = threading.Lock()
+        self.maxInFlight = 64
+        self.acks = 0
+        self.clockOffset = None
+        self.latency = StageProfiler(size=1000)
 
         print(getpid(), 'Creating Car...')
 
+    def connect(self):
+        """
+            Opens the serial port. If it can't be opened, it keeps retrying with an exponential
+            backoff until it succeeds or the stop signal is set. Returns True if connected.
+        """
+
+        delay = self.reconnectDelay[0]
+        while not self.stop.isSet():
+            try:
+                self.controller = serial.Serial(port=self.serialPort, baudrate=self.baudRate, timeout=0.1)
+                with self.condition:
+                    self.readError = False
+                print(getpid(), 'Car connected')
+                return True
+            except serial.serialutil.SerialException:
+                print('serial port cant be opened, retrying in %.1f s' % (delay))
+                self.stop.wait(delay)
+                delay = min(delay * 2, self.reconnectDelay[1])
+        return False
+
+    def disconnect(self):
+        """
+            Closes the serial port.
+        """
+
+        if self.controller:
+            try:
+                self.controller.close()
+            except serial.serialutil.SerialException:
+                pass
+            self.controller = None
+
+    def setCommand(self, command, stamp=None):
+        """
+            Sets the command that must be sent to the car. A command that was not sent yet
+            is replaced by the new one. Commands equal to the last one are coalesced.
+            The stamp is the (sequence, captureTime, processedTime) of the frame the
+            command was calculated from, with times from time.monotonic().
+        """
+
+        with self.condition:
+            self.lastSetTime = time.monotonic()
+            self.stale = False
+            if self.pendingCommand is not None:
+                if command == self.pendingCommand:
+                    self.coalesced += 1
+                    return
+                self.dropped += 1
+            elif command == self.lastCommand:
+                self.coalesced += 1
+                return
+            self.pendingCommand = command
+            self.pendingStamp = None if stamp is None else tuple(stamp) + (time.monotonic(),)
+            self.condition.notify()
+
+    def subscribe(self, interval):
+        """
+            Makes the STM32 push its status every interval seconds. An interval of 0 or
+            None stops the updates.
+        """
+
+        with self.condition:
+            self.statusInterval = interval
+            self.subscriptionPending = True
+            self.condition.notify()
+
+    def requestStatusUpdate(self):
+        """
+            Requests the status of the car and wakes up the writer.
+        """
+
+        with self.condition:
+            self.requestStatus.set()
+            self.condition.notify()
+
+    def shutdown(self):
+        """
+            Sets the stop signal and wakes up the writer so that the thread finishes.
+        """
+
+        with self.condition:
+            self.stop.set()
+            self.condition.notify()
+
+    def stats(self):
+        """
+            Returns the number of commands sent, coalesced, dropped and acknowledged.
+        """
+
+        return {'sent': self.sent, 'coalesced': self.coalesced, 'dropped': self.dropped, 'acks': self.acks}
+
+    def nextCommand(self):
+        """
+            Waits until there is a new command, a status request, the keep alive is due
+            or the stop signal is set. Returns the command that must be sent or None and
+            its stamp. Commands repeated as keep alive have no stamp. When no command was
+            set for maxCommandAge, the keep alive stops the car once instead.
+        """
+
+        with self.condition:
+            timeout = None
+            if self.keepAlive and self.lastCommand is not None and not self.stale:
+                timeout = max(self.lastSendTime + self.keepAlive - time.monotonic(), 0)
+            self.condition.wait_for(lambda: self.pendingCommand is not None or self.requestStatus.isSet() or self.subscriptionPending or self.readError or self.stop.isSet(), timeout)
+            command = self.pendingCommand
+            stamp = self.pendingStamp
+            self.pendingCommand = None
+            self.pendingStamp = None
+            if command is None and self.keepAlive and self.lastCommand is not None and not self.stale:
+                if time.monotonic() - self.lastSendTime >= self.keepAlive:
+                    if time.monotonic() - self.lastSetTime <= self.maxCommandAge:
+                        command = self.lastCommand
+                    else:
+                        print('No command for %.1f s, stopping the car' % (time.monotonic() - self.lastSetTime))
+                        command = 'VEL 0 0'
+                        self.stale = True
+            return command, stamp
+
     def run(self):
         """
-            Main run function. Monitors the commandQ for available commands
-            and sends them to the car. If the command requests data,
-            then it waits for it and sends it back.
+            Main run function. Waits for a new command and sends it to the car.
+            Status requests and subscriptions are sent as well, but the response
+            is handled by the reader thread. The serial port is kept open and
+            reopened only after an error.
         """
 
         print(getpid(), 'Starting Car...')
+        self.reader.start()
 
         # While the stop signal is not set continue running:
         while not self.stop.isSet():
 
-            # Open the serial interface with the 'with' version
-            # In case of an error, the with part will close
-            # the connection to the serial port automatically.
+            # Open the serial port if it is not open yet.
+            if not self.controller and not self.connect():
+                break
+
             try:
-                with serial.Serial(port=self.serialPort, baudrate=self.baudRate, timeout=1) as controller:
 
-                    # Send all available commands to the car.
-                    while not self.commandQ.empty() and not self.requestStatus.isSet():
+                # Wait for the latest command and send it to the car.
+                rawCommand, stamp = self.nextCommand()
 
-                        # Get a command from the q and make sure it ends with a
-                        # new line character.
-                        rawCommand = self.commandQ.get()
-                        if not rawCommand.endswith('\n'):
-                            rawCommand += '\n'
+                # The reader lost the port. The command is sent again after reconnecting.
+                if self.readError:
+                    if rawCommand is not None:
+                        self.lastCommand = rawCommand
+                    raise serial.serialutil.SerialException('read failed')
+                if rawCommand is not None:
+                    self.lastCommand = rawCommand
+                    self.lastSendTime = time.monotonic()
+                    sequence = stamp[0] & 0xFFFF if stamp and self.isVelocity(rawCommand) else None
+                    data = self.encodeCommand(rawCommand, sequence)
+                    if data:
+                        self.controller.write(data)
+                        self.sent += 1
+                        if sequence is not None:
+                            self.track(sequence, stamp)
 
-                        # Sends the comamnd to the car in ascii format.
-                        controller.write(rawCommand.encode('ascii', errors='ignore'))
+                # Check if the status flag is set and send the request.
+                if (self.requestStatus.isSet()):
+                    self.requestStatus.clear()
+                    if self.binary:
+                        self.controller.write(protocol.pack(protocol.STATUS_REQUEST))
+                    else:
+                        self.controller.write('STATUS\n'.encode('ascii', errors='ignore'))
 
-                        # Signal task completion.
-                        self.commandQ.task_done()
+                # Send the status subscription after connecting or when it changes.
+                if self.subscriptionPending:
+                    self.subscriptionPending = False
+                    interval = int((self.statusInterval or 0) * 1000)
+                    if self.binary:
+                        self.controller.write(protocol.pack(protocol.SUBSCRIBE, interval))
+                    else:
+                        self.controller.write(('SUB %d\n' % (interval)).encode('ascii', errors='ignore'))
 
-                    # Check if the status flag is set.
-                    if (self.requestStatus.isSet()):
-                        
-                        # Clear flag.
-                        self.requestStatus.clear()
+            # If the connection is lost, close the port and open it again.
+            # The last command is sent again once connected.
+            except serial.serialutil.SerialException:
+                print('serial port error, reconnecting')
+                self.disconnect()
+                with self.condition:
+                    if self.pendingCommand is None:
+                        self.pendingCommand = self.lastCommand
+                    self.subscriptionPending = self.statusInterval is not None
+        
+        self.disconnect()
+        print(getpid(), 'Killing Car...')
 
-                        # Send request command to controller.
-                        controller.write('STATUS\n'.encode('ascii', errors='ignore'))
+    def isVelocity(self, rawCommand):
+        """
+            Checks if a text command is a VEL command.
+        """
 
-                        # Read, process, and send back data.
-                        rawData = controller.readline()
-                        data = self.processStatus(rawData)
-                        self.messageQ.put(data)
+        return rawCommand.lstrip()[:4].upper() == 'VEL '
 
-                        # Display if debug is active.
-                        if (self.debug):
-                            print('\nSTATUS: ', data)
+    def encodeCommand(self, rawCommand, sequence=None):
+        """
+            Converts a text command into the bytes sent to the car. In binary mode the
+            VEL command becomes a VEL frame and unknown commands are ignored. A VEL
+            command with a sequence number is acknowledged by the car.
+        """
 
-                    # Wait a small time to avoid hanging the cpu.
-                    time.sleep(0.01)
+        if self.binary:
+            parts = rawCommand.split()
+            if len(parts) >= 3 and parts[0].upper() == 'VEL':
+                try:
+                    return protocol.packVelocity(int(parts[1]), int(parts[2]), sequence)
+                except ValueError:
+                    pass
+            return b''
 
-            # If for some reason the port can't be opened, catch error and stop thread.
-            except serial.serialutil.SerialException:
-                print('serial port cant be opened')
-                break
-        
-        print(getpid(), 'Killing Car...')
+        # Make sure the text command ends with a new line character.
+        rawCommand = rawCommand.rstrip('\n')
+        if sequence is not None:
+            rawCommand += ' %d' % (sequence)
+        return (rawCommand + '\n').encode('ascii', errors='ignore')
+
+    def track(self, sequence, stamp):
+        """
+            Keeps the stamp and the send time of a command until its ack arrives. The oldest
+            commands are forgotten if their ack never arrives.
+        """
+
+        with self.inFlightLock:
+            self.inFlight[sequence] = stamp + (time.monotonic(),)
+            while len(self.inFlight) > self.maxInFlight:
+                self.inFlight.popitem(last=False)
+
+    def acknowledge(self, sequence, carTime, receiveTime):
+        """
+            Records the latency of every step of an acknowledged command: processing of the frame
+            (process), control until the command was set (control), waiting for the writer (send),
+            the round trip to the car (ack), the capture until the car received the command (wheel)
+            and the capture until the ack arrived (total). carTime is the time in ms when the car
+            received the command. Its offset to the local clock is estimated from the fastest ack,
+            so wheel is too long by the fastest transfer from the car.
+        """
+
+        with self.inFlightLock:
+            stamp = self.inFlight.pop(sequence, None)
+        if stamp is None:
+            return
+        self.acks += 1
+        sequence, captureTime, processedTime, commandTime, writeTime = stamp
+
+        # The offset is restarted when the clock of the car jumps, e.g. after a reset.
+        offset = receiveTime - carTime / 1000
+        if self.clockOffset is None or offset < self.clockOffset or offset - self.clockOffset > 1.0:
+            self.clockOffset = offset
+
+        latency = self.latency
+        latency.record('process', processedTime - captureTime)
+        latency.record('control', commandTime - processedTime)
+        latency.record('send', writeTime - commandTime)
+        latency.record('ack', receiveTime - writeTime)
+        latency.record('wheel', carTime / 1000 + self.clockOffset - captureTime)
+        latency.record('total', receiveTime - captureTime)
+
+    def read(self):
+        """
+            Run function of the reader thread. Reads whatever data is available and
+            parses it incrementally. It never blocks the writer. A failed read makes
+            the writer reconnect the port.
+        """
+
+        while not self.stop.isSet():
+            controller = self.controller
+            if controller is None:
+                self.stop.wait(0.1)
+                continue
+            try:
+                data = controller.read(max(controller.in_waiting, 1))
+            except (serial.serialutil.SerialException, OSError, TypeError, AttributeError):
+
+                # Errors of a port the writer already closed are expected.
+                with self.condition:
+                    if controller is self.controller:
+                        self.readError = True
+                        self.condition.notify()
+                self.stop.wait(0.1)
+                continue
+            if data:
+                self.parse(data)
+
+    def parse(self, data):
+        """
+            Adds the received data to the buffer and publishes every complete status.
+        """
+
+        receiveTime = time.monotonic()
+        if self.binary:
+            for frameType, values in self.parser.feed(data):
+                if frameType == protocol.STATUS:
+                    self.publishStatus(self.processStatusFrame(values))
+                elif frameType == protocol.ACK:
+                    self.acknowledge(values[0], values[1], receiveTime)
+            return
+
+        # Text statuses are separated by new lines. The incomplete line stays in the buffer.
+        self.buffer += data
+        lines = self.buffer.split(b'\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            if line.startswith(b'ACK '):
+                self.processAck(line, receiveTime)
+                continue
+            status = self.processStatus(line)
+            if status:
+                self.publishStatus(status)
+
+    def publishStatus(self, status):
+        """
+            Stores the latest status and passes it to the callback.
+        """
+
+        self.status = status
+        self.statusCount += 1
+        if self.onStatus:
+            self.onStatus(status)
+
+        # Display if debug is active.
+        if (self.debug):
+            print('\nSTATUS: ', status)
+
+    def processAck(self, data, receiveTime):
+        """
+            Process a text ack: ACK sequence time.
+        """
+
+        parts = data.decode('ascii', errors='ignore').split()
+        if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
+            self.acknowledge(int(parts[1]), int(parts[2]), receiveTime)
+
+    def processStatusFrame(self, values):
+        """
+            Process the values of a binary STATUS frame. Voltages are sent in mV.
+        """
+
+        return {
+            'rpiBatteryVoltage': values[0] / 1000,
+            'motorBatteryVoltage': values[1] / 1000,
+            'motorBatteryCell1Voltage': values[2] / 1000,
+            'motorBatterycell2Voltage': values[3] / 1000,
+            'rpiBatteryCharge': values[4],
+            'motorBatteryCharge': values[5],
+            'shutdownFlag': values[6] == 1
+        }
 
     def processStatus(self, data):
         """
@@ -127,15 +464,16 @@ if __name__ == '__main__':
     """
         Small test for simulating sending commands to the car.
         Speed commands at 60Hz.
-        Status command at 1Hz.
+        Status pushed at 1Hz.
     """
-    car = Car('/dev/ttyAMA0', 115200, debug=True)
+    car = Car('/dev/ttyAMA0', 115200, debug=True, binary='--binary' in sys.argv, statusInterval=1.0)
     car.start()
     while True:
         try:
             for i in range(60):
-                car.commandQ.put('VEL 0 0')
+                car.setCommand('VEL %d %d' % (i // 20 * 10, i // 20 * 10))
                 time.sleep(1/60)
-            car.requestStatus.set()
+            print(car.stats(), car.status)
         except KeyboardInterrupt:
-            break;
\ No newline at end of file
+            break
+    car.shutdown()
\ No newline at end of file
@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import threading
+import time
+
+class Controller(threading.Thread):
+    """
+        PID lane keeping controller. The error is the -x distance between the filtered lanes and their
+        average position at the top of the ROI. The PID uses the measured time between lane estimates
+        and runs on its own fixed rate tick, independently of the frame rate. When the motors are
+        enabled, the calculated speed is sent to the car.
+    """
+
+    def __init__(self, averageLeft, averageRight, y0, car=None, rate=20, kp=0.05, ki=0.05, kd=0.01, integralLimit=50, baseSpeed=50):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.averageLeft = averageLeft
+        self.averageRight = averageRight
+        self.y0 = y0
+        self.car = car
+        self.rate = rate
+        self.stop = threading.Event()
+
+        # PID constants.
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.integralLimit = integralLimit
+
+        # Since the vehicle must only steer slightly, the vehicle has a base speed.
+        self.baseSpeed = baseSpeed
+
+        # Enabled via the C key and the M key.
+        self.enabled = False
+        self.motors = False
+
+        # Latest lanes estimate, set by the tracking stage.
+        self.lanes = None
+        self.lastTimestamp = None
+
+        # State and output of the PID. The lock is held by tick and toggle, since toggle runs on the
+        # UI thread.
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+            Clears the state and the output of the PID. The caller holds the lock while the thread runs.
+        """
+        self.sumError = 0
+        self.prevError = None
+        self.leftError = self.rightError = self.averageError = None
+        self.p = self.i = self.d = None
+        self.velLeft = self.velRight = None
+
+    def setLanes(self, left, right, timestamp=None, stamp=None):
+        """
+            Sets the latest filtered lanes. The timestamp is the time when they were estimated. The
+            stamp of the frame they were estimated from is passed to the car with the command.
+        """
+        self.lanes = (left, right, time.monotonic() if timestamp is None else timestamp, stamp)
+
+    def error(self, left, right):
+        """
+            Calculates the error on both lanes and their average.
+        """
+        leftError = self.averageLeft(self.y0) - left(self.y0)
+        rightError = self.averageRight(self.y0) - right(self.y0)
+        return leftError, rightError, (leftError + rightError) / 2
+
+    def update(self, averageError, dt):
+        """
+            Calculates the PID terms for an error measured dt seconds after the previous one and returns
+            the velocity of the left and right wheel.
+        """
+
+        # Calculate the PID terms. The derivative is 0 for the first error.
+        sumError = min(max(self.sumError + averageError * self.ki * dt, -self.integralLimit), self.integralLimit)
+        p = self.kp * averageError
+        i = sumError
+        prevError = self.prevError
+        if prevError is None or dt <= 0:
+            d = 0
+        else:
+            d = (averageError - prevError) * self.kd / dt
+
+        # Add P, I, and D terms to get the PID control.
+        pid = p + i + d
+        velLeft = int(self.baseSpeed - pid)
+        velRight = int(self.baseSpeed + pid)
+
+        # Constrains the speed to be within 0 and 100%.
+        velLeft = min(max(velLeft, 0), 100)
+        velRight = min(max(velRight, 0), 100)
+
+        # The terms are only published once they are all calculated.
+        self.sumError, self.prevError = sumError, averageError
+        self.p, self.i, self.d = p, i, d
+        self.velLeft, self.velRight = velLeft, velRight
+        return velLeft, velRight
+
+    def tick(self):
+        """
+            Runs the PID with the latest lanes if there is a new estimate and sends the speed to the car
+            when the motors are enabled. Returns True if the PID was updated.
+        """
+
+        with self.lock:
+            lanes = self.lanes
+            if not self.enabled or lanes is None:
+                return False
+            left, right, timestamp, stamp = lanes
+            if timestamp == self.lastTimestamp:
+                return False
+            dt = 0 if self.lastTimestamp is None else timestamp - self.lastTimestamp
+            self.lastTimestamp = timestamp
+
+            self.leftError, self.rightError, self.averageError = self.error(left, right)
+            velLeft, velRight = self.update(self.averageError, dt)
+            motors = self.motors
+        if motors and self.car:
+            self.car.setCommand('VEL %d %d' % (velLeft, velRight), stamp)
+        return True
+
+    def toggle(self):
+        """
+            Enables or disables the PID calculations. The motors are always disabled.
+        """
+        with self.lock:
+            self.enabled = not self.enabled
+            self.motors = False
+            self.lastTimestamp = None
+            self.reset()
+            return self.enabled
+
+    def run(self):
+        """
+            Calls tick at a fixed rate until the stop signal is set.
+        """
+        period = 1.0 / self.rate
+        nextTime = time.monotonic()
+        while not self.stop.is_set():
+            self.tick()
+            nextTime += period
+            delay = nextTime - time.monotonic()
+            if delay > 0:
+                self.stop.wait(delay)
+            else:
+                nextTime = time.monotonic()
+
+def replayErrors(controller, errors, times):
+    """
+        Runs a sequence of errors measured at the given times through the PID. Returns the velocities
+        of both wheels and the time per update in us.
+    """
+
+    velocities = np.zeros((len(errors), 2))
+    t0 = time.perf_counter()
+    previous = None
+    for n, (error, timestamp) in enumerate(zip(errors, times)):
+        velocities[n] = controller.update(error, 0 if previous is None else timestamp - previous)
+        previous = timestamp
+    return velocities, (time.perf_counter() - t0) / max(len(errors), 1) * 1e6
+
+if __name__ == '__main__':
+
+    """
+        Small test that replays the lane errors of a recording, or synthetic errors if no recording is
+        given, through the controller and reports the output and the cost of an update.
+    """
+    import sys
+
+    if len(sys.argv) > 1:
+        from recorder import load
+        run = load(sys.argv[1])
+        valid = ~np.isnan(run['averageError'])
+        errors = run['averageError'][valid].astype(float)
+        times = run['time'][valid]
+    else:
+        times = np.cumsum(np.random.uniform(0.04, 0.06, 1000))
+        errors = 30 * np.sin(times) + np.random.normal(0, 3, len(times))
+
+    controller = Controller(np.poly1d([-3.45, 778.36]), np.poly1d([3.66, -328.14]), 0.57 * 320)
+    velocities, cost = replayErrors(controller, errors, times)
+    print('Errors: %d, mean %.2f, std %.2f' % (len(errors), np.mean(errors), np.std(errors)))
+    print('Left wheel: mean %.1f%%, min %.1f%%, max %.1f%%' % (velocities[:, 0].mean(), velocities[:, 0].min(), velocities[:, 0].max()))
+    print('Right wheel: mean %.1f%%, min %.1f%%, max %.1f%%' % (velocities[:, 1].mean(), velocities[:, 1].min(), velocities[:, 1].max()))
+    print('Update: %.2f us' % (cost))
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import cv2
+
+class HoughEngine():
+    """
+        Finds the segments of the lanes with the probabilistic Hough transform and splits them into the
+        left and right lane by their angle. Its cost grows with the number of edges in the ROI.
+    """
+
+    # The engine receives the edges masked by the ROI.
+    masked = True
+
+    def __init__(self, processor):
+        self.processor = processor
+
+    def search(self, roi, offsetY=0, scale=1):
+        """
+            Runs the Hough transform on the edges of the ROI. Returns the segments in full frame
+            coordinates.
+        """
+
+        p = self.processor
+        houghLines = cv2.HoughLinesP(
+            roi,
+            rho = 1,
+            theta = np.pi / 180,
+            threshold = max(p.houghThreshold // scale, 1),
+            lines = np.array([]),
+            minLineLength = p.houghMinLineLength / scale,
+            maxLineGap = p.houghMaxLineGap / scale
+        )
+        if scale > 1 and houghLines is not None:
+            houghLines *= scale
+        if offsetY and houghLines is not None:
+            houghLines[:, :, 1] += offsetY
+            houghLines[:, :, 3] += offsetY
+        return houghLines
+
+    def parameters(self):
+        """
+            Returns the settings the result of the search depends on.
+        """
+        p = self.processor
+        return (p.houghThreshold, p.houghMinLineLength, p.houghMaxLineGap)
+
+    def pack(self, segments):
+        """
+            Converts the result of the search into a dictionary of arrays for a StageCache.
+        """
+        return {} if segments is None else {'segments': segments}
+
+    def unpack(self, entry):
+        return entry.get('segments')
+
+    def lanes(self, frame, segments, drawAll=False):
+        """
+            Assigns the segments to the lanes and fits them.
+        """
+        return self.processor.findLanes(frame, segments, minAngle=self.processor.minAngle, drawAll=drawAll)
+
+class HistogramEngine():
+    """
+        Finds the lanes from column histograms of the edges. The rows of the ROI are split into
+        horizontal slices and the histogram of each slice is smoothed so that both edges of a lane
+        mark form a single peak. Starting from the bottom slice, the peak of each lane is searched in
+        a window around its peak in the previous slice, or in its half of the frame if there is none.
+        The position of a peak is the centroid of the histogram around it. The edges are not masked
+        by the ROI, since lanes cut by its sides would give biased peaks; instead peaks outside of the
+        ROI are ignored. The lanes are fitted directly to the peaks by the same Line class. The cost
+        depends only on the size of the ROI and the number of slices.
+    """
+
+    # The engine receives the edges of the whole band instead of the masked ROI.
+    masked = False
+
+    def __init__(self, processor, slices=8, smoothing=21, window=30, minPixels=5):
+        self.processor = processor
+        self.slices = slices
+        self.smoothing = smoothing
+        self.window = window
+        self.minPixels = minPixels
+
+    def search(self, edges, offsetY=0, scale=1):
+        """
+            Finds the peaks of both lanes in every slice. Returns an array with the -x coordinate of
+            the left and right peak of every slice from the bottom up, NaN where there is no peak, and
+            the -y coordinate of every slice in full frame coordinates.
+        """
+
+        p = self.processor
+        y0 = max(int((p.h * p.roiY[0] - offsetY) / scale), 0)
+        y1 = min(int((p.h * p.roiY[1] - offsetY) / scale) + 1, edges.shape[0])
+        w = edges.shape[1]
+
+        # Edge pixels in a window around every column of every slice. Resizing the band with the area
+        # interpolation averages the rows of each slice. The histograms use working buffers of the processor.
+        rowsPerSlice = (y1 - y0) / self.slices
+        smoothing = self.smoothing // scale | 1
+        band = cv2.resize(edges[y0:y1], (w, self.slices), dst=p.getBuffer('histogramBand', (self.slices, w)), interpolation=cv2.INTER_AREA)
+        histograms = p.getBuffer('histograms', (self.slices, w), np.float32)
+        np.copyto(histograms, band)
+        cv2.blur(histograms, (smoothing, 1), dst=histograms)
+        histograms *= smoothing * rowsPerSlice / 255
+
+        # The -y coordinate of a peak is the center of its slice. Peaks must be between the sides of
+        # the ROI at that row.
+        ys = (y1 - (np.arange(self.slices) + 0.5) * rowsPerSlice) * scale + offsetY
+        t = (ys - p.h * p.roiY[0]) / (p.h * (p.roiY[1] - p.roiY[0]))
+        sides = ((1 - p.roiX[0]) + t * (p.roiX[0] - p.roiX[1])) * p.w / 2
+
+        # Track the peaks from the bottom up.
+        peaks = np.full((self.slices, 2), np.nan)
+        window = max(self.window // scale, 1)
+        minPixels = self.minPixels / scale
+        previous = [None, None]
+        for i in range(self.slices):
+            histogram = histograms[self.slices - 1 - i]
+            for lane, (low, high) in enumerate(((0, w // 2), (w // 2, w))):
+                start, end = low, high
+                if previous[lane] is not None:
+                    start = max(previous[lane] - window, low)
+                    end = min(previous[lane] + window + 1, high)
+                if end <= start:
+                    previous[lane] = None
+                    continue
+                x = start + int(np.argmax(histogram[start:end]))
+                peak = histogram[x]
+                if peak < minPixels:
+                    previous[lane] = None
+                    continue
+
+                # A slanted lane forms a plateau, so the peak is the centroid of the part around the
+                # maximum that is above half of it.
+                start = max(x - window, low)
+                end = min(x + window + 1, high)
+                weights = histogram[start:end] - peak / 2
+                np.maximum(weights, 0, out=weights)
+                x = start + np.dot(weights, np.arange(end - start)) / weights.sum()
+                previous[lane] = int(x)
+                if sides[i] <= x * scale <= p.w - sides[i]:
+                    peaks[i, lane] = x * scale
+        return peaks, ys
+
+    def parameters(self):
+        """
+            Returns the settings the result of the search depends on.
+        """
+        return (self.slices, self.smoothing, self.window, self.minPixels)
+
+    def pack(self, search):
+        """
+            Converts the result of the search into a dictionary of arrays for a StageCache.
+        """
+        return {'peaks': search[0], 'ys': search[1]}
+
+    def unpack(self, entry):
+        return entry['peaks'], entry['ys']
+
+    def lanes(self, frame, search, drawAll=False):
+        """
+            Fits the lanes to the peaks. Every peak is stored in its Line as a segment of length 0.
+        """
+
+        peaks, ys = search
+        p = self.processor
+        for lane, line in enumerate((p.left, p.right)):
+            x = peaks[:, lane]
+            valid = ~np.isnan(x)
+            points = np.stack((x, ys), axis=1)[valid]
+            line.set(np.round(np.hstack((points, points))).astype(np.int32))
+            line.fit()
+        if drawAll:
+            p.drawSegments(frame)
+        return frame
+
+# Engines by name.
+ENGINES = {
+    'hough': HoughEngine,
+    'histogram': HistogramEngine
+}
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+def makeLevels(processor, maxScale=4):
+    """
+        Returns the quality levels of an image processor from the best to the cheapest. Every level is
+        a set of ImageProcessor settings. The first level is the current configuration of the processor
+        and every further level is cheaper than the previous one: no segment overlay, one blur pass
+        less, a single blur pass with a 50% stricter Hough threshold and twice the scale. Levels that
+        don't change anything, e.g. when the processor already runs at maxScale, are left out.
+    """
+
+    level = {
+        'drawAll': processor.drawAll,
+        'blurIterations': processor.blurIterations,
+        'houghThreshold': processor.houghThreshold,
+        'scale': processor.scale
+    }
+    levels = [level]
+    for changes in (
+        {'drawAll': False},
+        {'blurIterations': max(level['blurIterations'] - 1, 1)},
+        {'blurIterations': 1, 'houghThreshold': int(processor.houghThreshold * 1.5)},
+        {'scale': min(processor.scale * 2, maxScale)}
+    ):
+        level = dict(levels[-1], **changes)
+        if level != levels[-1]:
+            levels.append(level)
+    return tuple(levels)
+
+class QualityGovernor():
+    """
+        Keeps the processing time of a frame under a deadline by changing the quality level of an
+        image processor. When the mean duration of the last frames is over the deadline the quality
+        is reduced by one level. The quality is increased again once the frames have been faster than
+        a fraction (slack) of the deadline for a number of consecutive frames. By default the levels
+        are made from the settings of the processor when the governor is created.
+    """
+
+    def __init__(self, processor, deadline=None, levels=None, window=10, slack=0.6, patience=40):
+        self.processor = processor
+        self.deadline = deadline if deadline else 1.0 / processor.frameRate
+        self.levels = levels if levels else makeLevels(processor)
+        self.window = window
+        self.slack = slack
+        self.patience = patience
+        self.durations = np.zeros(window)
+        self.count = 0
+        self.fastFrames = 0
+        self.changes = 0
+        self.level = 0
+        self.processor.setQuality(**self.levels[0])
+
+    def update(self, duration):
+        """
+            Adds the duration in s of a processed frame and changes the level if needed. Returns the
+            current level.
+        """
+
+        self.durations[self.count % self.window] = duration
+        self.count += 1
+        if duration < self.deadline * self.slack:
+            self.fastFrames += 1
+        else:
+            self.fastFrames = 0
+
+        if self.count >= self.window and self.durations.mean() > self.deadline:
+            if self.level < len(self.levels) - 1:
+                self.setLevel(self.level + 1)
+        elif self.fastFrames >= self.patience and self.level > 0:
+            self.setLevel(self.level - 1)
+        return self.level
+
+    def setLevel(self, level):
+        """
+            Applies the settings of a level to the image processor and restarts the measurements.
+        """
+
+        print('Quality level %d -> %d (%.1f ms, deadline %.1f ms)' % (
+            self.level, level, self.durations[:min(self.count, self.window)].mean() * 1000, self.deadline * 1000
+        ))
+        self.processor.setQuality(**self.levels[level])
+        self.level = level
+        self.changes += 1
+        self.count = 0
+        self.fastFrames = 0
@@ -5,7 +5,7 @@ import numpy as np
 
 class Line():
     """
-        Line class for storing the points found by the Hough Transform and
+        Line class for storing the segments found by the Hough Transform and
         fitting them to a 1st order polynomial.
     """
 
@@ -14,34 +14,49 @@ class Line():
         self.color = color
         self.w = frameDimensions[0]
         self.h = frameDimensions[1]
-        self.x = []
-        self.y = []
+        self.clear()
         self.poly = None
 
     def add(self, x0, y0, x1, y1):
         """
-            Adds a set of points to the arrays used to create the fit.
+            Adds a single segment to the arrays used to create the fit.
         """
-        self.x.extend([x0, x1])
-        self.y.extend([y0, y1])
+        self.set(np.vstack((self.segments, np.array([[x0, y0, x1, y1]], np.int32))))
+
+    def set(self, segments):
+        """
+            Replaces the stored data with an array of segments with shape (N, 4). The -x and -y
+            coordinates of both ends of every segment are used for the fit.
+        """
+        self.segments = segments
+        self.x = segments[:, 0::2].ravel()
+        self.y = segments[:, 1::2].ravel()
 
     def clear(self):
         """
             Clears all points for the arrays.
         """
-        self.x = []
-        self.y = []
+        self.set(np.empty((0, 4), np.int32))
 
     def fit(self):
         """
             Fits the data to a first order polynomial. Returns the fitted polynomial
             as a function of the -y coordinate, ie. x = f(y) = m * y + b.
+            Uses the closed form of the least squares solution.
 
         """
-        if len(self.x) > 0 and len(self.y) > 0:
-            self.poly = np.poly1d(np.polyfit(self.y, self.x, deg=1))
-        else:
-            self.poly = None    
+        self.poly = None
+        n = len(self.x)
+        if n > 0:
+            x = self.x.astype(np.float64)
+            y = self.y.astype(np.float64)
+            sy = y.sum()
+            sx = x.sum()
+            denominator = n * np.dot(y, y) - sy * sy
+            if denominator != 0:
+                m = (n * np.dot(y, x) - sy * sx) / denominator
+                b = (sx - m * sy) / n
+                self.poly = np.poly1d([m, b])
         return self.poly
 
     def eval(self, y0, y1):
@@ -59,4 +74,4 @@ class Line():
                 y1Px
             ]
         else:
-            return [0, y0Px, 0, y1Px]
\ No newline at end of file
+            return [0, y0Px, 0, y1Px]
@@ -1,34 +1,114 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-from imutils.video.pivideostream import PiVideoStream
+# The startup is timed from before the imports.
+import time
+startTime = time.perf_counter()
+
+from pipeline import LatestSlot, Stage
+from preview import PreviewServer
 from processor import ImageProcessor
-from tracker import Tracker
+from governor import QualityGovernor
+from profiler import StageProfiler, StartupReport
+from recorder import Recorder, STAGES
+from source import openSource
+from tracker import LaneTracker
+from controller import Controller
 from car import Car
 import numpy as np
-import time
+import argparse
 import cv2
 
+# Read the command line arguments.
+parser = argparse.ArgumentParser(description='Lane keeping system.')
+parser.add_argument('--source', default=None, help='video file, directory of images or .npy frame stack used instead of the camera')
+parser.add_argument('--roi-only', action='store_true', help='run the image processor only on the band of the ROI')
+parser.add_argument('--engine', default='hough', choices=('hough', 'histogram'), help='engine that finds the lanes in the edges of the ROI')
+parser.add_argument('--scale', type=int, default=1, choices=(1, 2, 4), help='process the frames at 1 / scale of their resolution')
+parser.add_argument('--scale-method', default='pyrDown', choices=('pyrDown', 'remap'), help='reduce the undistorted frame with pyrDown or undistort directly into the reduced resolution')
+parser.add_argument('--corridors', action='store_true', help='run the Hough transform only around the lanes predicted by the tracker, not used with --workers or the histogram engine')
+parser.add_argument('--profile', action='store_true', help='time every stage of the image processor and display it on the frame')
+parser.add_argument('--pipelined', action='store_true', help='run capture, vision and control in separate threads')
+parser.add_argument('--workers', type=int, default=0, help='run the image processor in this many worker processes, implies --pipelined, needs Python 3.8')
+parser.add_argument('--binary', action='store_true', help='talk to the car with the binary protocol instead of the text protocol')
+parser.add_argument('--deadline', type=float, default=None, help='adapt the image processing quality, including the scale, to process a frame within this many ms, not used with --workers')
+parser.add_argument('--record', default=None, help='file where the telemetry of every frame is recorded')
+parser.add_argument('--headless', action='store_true', help='serve the preview as an MJPEG stream and receive the keys over HTTP instead of opening a window')
+parser.add_argument('--preview-host', default='127.0.0.1', help='address of the preview server in headless mode')
+parser.add_argument('--preview-port', type=int, default=8080, help='port of the preview server in headless mode')
+parser.add_argument('--preview-rate', type=float, default=5, help='frames per second sent to the viewers in headless mode')
+args = parser.parse_args()
+startup = StartupReport(startTime)
+startup.mark('imports')
+
 # Define the average positions for the left and right lanes.
 averageLeft = np.poly1d(np.array([-3.45, 778.36]))
 averageRight = np.poly1d(np.array([3.66, -328.14]))
 
-# Initialize the communications with the car via serial.
-car = Car('/dev/ttyAMA0', 115200)
+# Initalize the camera processor, defines the frame rate and frame size.
+profiler = StageProfiler(logInterval=5) if args.profile else None
+processor = ImageProcessor((480, 320), 20, profiler=profiler, roiOnly=args.roi_only, corridors=args.corridors, engine=args.engine, scale=args.scale, scaleMethod=args.scale_method)
+startup.mark('processor')
+
+# Optionally adapt the quality of the image processor to meet the deadline of a frame.
+governor = QualityGovernor(processor, args.deadline / 1000) if args.deadline else None
+
+# Optionally run the image processor in worker processes instead.
+# The worker module needs Python 3.8 for its shared memory, so it is only imported when it is used.
+# The workers are forked before any thread is started, so that they don't inherit locks held by a
+# thread or the serial port.
+pool = None
+if args.workers:
+    from worker import VisionPool
+    pool = VisionPool(processor.frameDimensions, processor.frameRate, workers=args.workers, options={'roiOnly': args.roi_only, 'engine': args.engine, 'scale': args.scale, 'scaleMethod': args.scale_method}).start()
+    startup.mark('workers')
+
+# Initialize the communications with the car via serial. The car starts threads, so it is created
+# after the worker processes are forked.
+car = Car('/dev/ttyAMA0', 115200, keepAlive=0.5, binary=args.binary, statusInterval=1.0)
 car.start()
 command = ''
+startup.mark('car')
 
-# Initalize the camera processor, defines the frame rate and frame size.
-processor = ImageProcessor((480, 320), 20)
+# Open the preview window, or in headless mode the preview server.
+preview = None
+if args.headless:
+    preview = PreviewServer(args.preview_host, args.preview_port, rate=args.preview_rate)
+    preview.start()
+    print('Preview on http://%s:%d/' % preview.address)
+else:
+    cv2.namedWindow('main', cv2.WINDOW_AUTOSIZE)
+startup.mark('window')
+
+# Open the frame source. By default it is the threaded version of the PiCamera class.
+# Instead of a fixed warm-up, wait until the first frame arrives.
+camera = openSource(args.source, processor.frameDimensions, processor.frameRate, loop=True).start()
+if not camera.waitReady(5.0):
+    print('No frame received from the camera after 5 s')
+startup.mark('camera')
+
+# Optionally record the telemetry of every frame.
+recorder = None
+if args.record:
+    recorder = Recorder(args.record)
+    recorder.start()
+
+# Create a Kalman Filter for the left and right lanes. It is updated with the time between the
+# captures of the frames. Its prediction at the top and bottom rows of the ROI sets the corridors
+# of the processor.
+laneTracker = LaneTracker()
+lastCaptureTime = None
 
-# Open the threaded version of the PiCamera class.
-cv2.namedWindow('main', cv2.WINDOW_AUTOSIZE)
-camera = PiVideoStream(resolution=processor.frameDimensions, framerate=processor.frameRate).start()
-time.sleep(2)
+# Unfiltered lanes of the latest frame, found by the processor or by the workers.
+lastLanes = (None, None)
+corridorRows = (processor.roiY[0] * processor.h, processor.roiY[1] * processor.h)
 
-# Create a Kalman Filter for the left and right lanes.
-rightTracker = Tracker()
-leftTracker = Tracker()
+# Create the PID controller. It runs at the frame rate, but independently of the frames.
+controller = Controller(averageLeft, averageRight, processor.roiY[0] * processor.h, car=car, rate=processor.frameRate)
+controller.start()
+startup.mark('control')
+print('Startup:')
+print(startup.report())
 
 def writeCarStatus(frame, status):
     """
@@ -40,160 +120,317 @@ def writeCarStatus(frame, status):
         cv2.putText(frame, 'Motor: %.2f v' % (status['motorBatteryVoltage']), (10, 45), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 0), 1)
     return frame
 
-def main():
+def detect(captured):
+    """
+        Vision stage. Processes the frame to extract the lanes. The captured frame comes with its
+        sequence number and capture time, which are stamped with the time its processing ended.
+        In headless mode the segments are only drawn when the frame will be sent to the viewers.
+    """
+
+    frame, sequence, captureTime = captured
+    t0 = time.perf_counter()
+    out = processor.process(frame, draw=preview is None or preview.due())
+    if governor:
+        governor.update(time.perf_counter() - t0)
+    return out, processor.left.poly, processor.right.poly, (sequence, captureTime, time.monotonic())
+
+def control(detection):
+    """
+        Tracking stage. Filters the lanes, passes them to the controller and sends the manual
+        command to the car while the motors are not controlled by the PID.
+    """
+
+    global lastCaptureTime, lastLanes
+    out, leftPoly, rightPoly, stamp = detection
+    lastLanes = (leftPoly, rightPoly)
+
+    # 3. Passes the found lanes to the Kalman Filter.
+    captureTime = stamp[1]
+    dt = None if lastCaptureTime is None else captureTime - lastCaptureTime
+    lastCaptureTime = captureTime
+    left, right = laneTracker.add(leftPoly, rightPoly, dt)
+    if processor.corridors:
+        processor.setPrediction(*laneTracker.prediction(corridorRows))
+
+    # 5. The controller calculates the PID on its own tick with the latest lanes.
+    controller.setLanes(left, right, stamp=stamp)
+    errors = None
+    with controller.lock:
+        if controller.enabled and controller.leftError is not None:
+            errors = (controller.leftError, controller.rightError)
+
+    # Sends the manual command to the vehicle. Unchanged commands are coalesced by the car.
+    if not controller.motors and command:
+        car.setCommand(command)
+
+    # Records the telemetry of the frame.
+    if recorder:
+        status = car.status or {}
+        recorder.record(
+            rawLeft=leftPoly.coeffs if leftPoly else None,
+            rawRight=rightPoly.coeffs if rightPoly else None,
+            left=left.coeffs,
+            right=right.coeffs,
+            leftError=controller.leftError,
+            rightError=controller.rightError,
+            averageError=controller.averageError,
+            p=controller.p,
+            i=controller.i,
+            d=controller.d,
+            velLeft=controller.velLeft,
+            velRight=controller.velRight,
+            rpiBatteryVoltage=status.get('rpiBatteryVoltage'),
+            motorBatteryVoltage=status.get('motorBatteryVoltage'),
+            qualityLevel=governor.level if governor else None,
+            stages=[profiler.last(stage) for stage in STAGES] if profiler else None
+        )
+
+    return out, left, right, errors
+
+def render(result):
+    """
+        Display stage. Draws the lanes and the status on the frame, displays it and processes
+        the key presses. Returns False once the program must quit. In headless mode, frames that
+        are not sent to the viewers are not drawn at all.
+    """
+
+    out, left, right, errors = result
+    if preview and not preview.due():
+        return handleKeys()
+
+    # 4. Draws the unfiltered lanes.
+    # processor.drawPoly(out, processor.left.poly, (0, 100, 200))
+    # processor.drawPoly(out, processor.right.poly, (200, 100, 0))
+
+    # 4. Draws the output of the Kalman Filter.
+    processor.drawPoly(out, left, (0, 50, 255))
+    processor.drawPoly(out, right, (255, 50, 0))
+
+    # 4. Draws the average position for the lanes.
+    processor.drawPoly(out, averageLeft, (255, 255, 255))
+    processor.drawPoly(out, averageRight, (255, 255, 255))
 
-    global command, camera, processor
-    
-    statusRequestTime = time.time()
-    latestCarStatus = None
-    enableControl = False
-    enableMotors = False
+    # Displays the error on the frame.
+    if errors:
+        y0 = processor.roiY[0] * processor.h
+        cv2.putText(out, '%.2f' % (errors[0]), (int(averageLeft(y0)), int(y0) + 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 0), 1)
+        cv2.putText(out, '%.2f' % (errors[1]), (int(averageRight(y0)), int(y0) + 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 0), 1)
 
-    pid = 0
-    sumError = 0
-    averageError = 0
-    prevError = 0
-    dt = 1.0 / 20
+    # Draw the current status of the vehicle on the frame.
+    # The car pushes the status of its batteries every second.
+    out2 = writeCarStatus(out, car.status)
+    if profiler:
+        profiler.draw(out2)
+    if governor:
+        cv2.putText(out2, 'Quality: %d' % (governor.level), (10, 300), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1)
 
+    # Display the output image.
+    if preview:
+        preview.publish(out2)
+    else:
+        cv2.imshow('main', out2)
+    return handleKeys()
+
+def handleKeys():
+    """
+        Processes the pending key presses, received by the preview server in headless mode or by the
+        window. Returns False if the program must quit.
+    """
+
+    if preview:
+        for key in preview.keys():
+            if not handleKey(key):
+                return False
+        return True
+    return handleKey(cv2.waitKey(1) & 0xFF)
+
+def handleKey(key):
+    """
+        Reads any key press and process them. Returns False if the program must quit.
+        w - Move forward.
+        s - Move backward.
+        d - Move right.
+        a - Move left.
+        Space - Stop.
+        q - Quit.
+        k - Print coefficients of the unfiltered lanes.
+        c - Enable PID calculations.
+        m - Enable motors to be controlled by the PID control loop.
+    """
+
+    global command
+    if key == ord('q'):
+        return False
+    elif key == ord('k'):
+        for name, poly in zip(('Left: ', 'Right: '), lastLanes):
+            print(name, poly.coeffs if poly else None)
+    elif key == ord('w'):
+        command = 'VEL 50 50'
+    elif key == ord('s'):
+        command = 'VEL -50 -50'
+    elif key == ord('a'):
+        command = 'VEL 0 50'
+    elif key == ord('d'):
+        command = 'VEL 50 0'
+    elif key == ord(' '):
+        command = 'VEL 0 0'
+    elif key == ord('c'):
+        motors = controller.motors
+        if controller.toggle():
+            print('CONTROL ON')
+        else:
+            print('CONTROL OFF')
+        # Turning the control off also turns the motors off, so the car must stop.
+        if motors:
+            command = 'VEL 0 0'
+    elif key == ord('m'):
+        controller.motors = not controller.motors
+        if controller.motors:
+            print('MOTORS ON')
+        else:
+            print('MOTORS OFF')
+            command = 'VEL 0 0'
+    return True
+
+def runSequential():
+    """
+        Runs all the stages one after the other for every frame. When the loop is faster than the
+        camera, the frame it returns again is not processed again; only the keys are handled.
+    """
+
+    statsTime = time.time()
+    lastSequence = None
+    duplicates = 0
     while True:
 
         # 1. Reads frame from the camera.
-        frame = camera.read()
-
-        # 2. Processes the frame to extract the lanes.
-        out = processor.process(frame)
-        
-        # 3. Passes the found lanes to the Kalman Filter.
-        left = leftTracker.add(processor.left.poly)
-        right = rightTracker.add(processor.right.poly)
-
-        # 4. Draws the unfiltered lanes.
-        # processor.drawPoly(out, processor.left.poly, (0, 100, 200))
-        # processor.drawPoly(out, processor.right.poly, (200, 100, 0))
-
-        # 4. Draws the output of the Kalman Filter.
-        processor.drawPoly(out, left, (0, 50, 255))
-        processor.drawPoly(out, right, (255, 50, 0))
-
-        # 4. Draws the average position for the lanes.
-        processor.drawPoly(out, averageLeft, (255, 255, 255))
-        processor.drawPoly(out, averageRight, (255, 255, 255))
-
-        # Once the control is enabled via the C key.
-        if enableControl:
-
-            # Calculates the error on both lanes.
-            y0 = processor.roiY[0] * processor.h
-            leftError = averageLeft(y0) - left(y0)
-            rightError = averageRight(y0) - right(y0)
-            averageError = (leftError + rightError) / 2
-
-            # Displays the error on the frame.
-            cv2.putText(out, '%.2f' % (leftError), (int(averageLeft(y0)), int(y0) + 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 0), 1)
-            cv2.putText(out, '%.2f' % (rightError), (int(averageRight(y0)), int(y0) + 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 0), 1)
-
-            # Define PID constants.
-            kp = 0.05
-            ki = 0.05
-            kd = 0.01
-            
-            # 5. Calculate the PID terms. 
-            prevError = averageError
-            sumError += averageError * ki * dt
-            if sumError > 50:
-                sumError = 50
-            elif sumError < -50:
-                sumError = -50
-            p = kp * averageError
-            i = sumError
-            d = (averageError - prevError) * kd / dt
-
-            # Add P, I, and D terms to get the PID control. Since the vehicle must only steer slightly, the vehicle has
-            # a base speed.
-            pid = p + i + d
-            baseSpeed = 50
-            velLeft = int(baseSpeed - pid)
-            velRight = int(baseSpeed + pid)
-
-            # Constrains the speed to be within 0 and 100%.
-            if velLeft < 0:
-                velLeft = 0
-            elif velLeft > 100:
-                velLeft = 100
-            if velRight < 0:
-                velRight = 0
-            elif velRight > 100:
-                velRight = 100
-
-            # If motors are enabled via the M key, sends the calculated speed to the car.
-            if enableMotors:
-                command = 'VEL %d %d \t PID %.1f P %.1f I %.1f D %.1f' % (velLeft, velRight, pid, p, i ,d)
-                print(command)
-
-        # Draw the current status of the vehicle on the frame.
-        out2 = writeCarStatus(out, latestCarStatus)
-
-        # Display the output image.
-        cv2.imshow('main', out2)
+        captured = camera.readStamped()
+        if captured[0] is None or captured[1] == lastSequence:
+            duplicates += 1
+            if not handleKeys():
+                break
+            if preview:
+                time.sleep(0.001)
+            continue
+        lastSequence = captured[1]
 
-        # Reads any key press and process them.
-        # w - Move forward.
-        # s - Move backward.
-        # d - Move right.
-        # a - Move left.
-        # Space - Stop.
-        # q - Quit.
-        # k - Print coefficients of the unfiltered lanes.
-        # c - Enable PID calculations.
-        # m - Enable motors to be controlled by the PID control loop.
-        key = cv2.waitKey(1) & 0xFF
-        if key == ord('q'):
+        # 2. - 5. Detects the lanes, calculates the control and displays the result.
+        if not render(control(detect(captured))):
             break
-        elif key == ord('k'):
-            print('Left: ', processor.left.poly.coeffs)
-            print('Right: ', processor.right.poly.coeffs)
-        elif key == ord('w'):
-            command = 'VEL 50 50'
-        elif key == ord('s'):
-            command = 'VEL -50 -50'
-        elif key == ord('a'):
-            command = 'VEL 0 50'
-        elif key == ord('d'):
-            command = 'VEL 50 0'
-        elif key == ord(' '):
-            command = 'VEL 0 0'
-        elif key == ord('c'):
-            enableControl = not enableControl
-            if enableControl:
-                print('CONTROL ON')
-            else:
-                print('CONTROL OFF')
-            enableMotors = False
-        elif key == ord('m'):
-            enableMotors = not enableMotors
-            if enableMotors:
-                print('MOTORS ON')
-            else:
-                print('MOTORS OFF')
-                command = 'VEL 0 0'
-
-        # Sends a command to the vehicle.
-        car.commandQ.put(command)
-
-        # Request every second the status from the vehicle's batteries.
-        if time.time() - statusRequestTime > 1.0:
-            car.requestStatus.set()
-            statusRequestTime = time.time()
-        
-        # Read the status from the car.
-        while not car.messageQ.empty():
-            latestCarStatus = car.messageQ.get()
-
-    # Close communications with the camera and car.
-    # Close allw windows.
-    car.stop.set()
-    camera.stop()
-    cv2.destroyAllWindows()
+        if time.time() - statsTime > 5.0:
+            if car.acks:
+                print('latency: %s' % (car.latency.logLine()))
+            if duplicates:
+                print('duplicate frames skipped: %d' % (duplicates))
+            statsTime = time.time()
+
+def runPipelined():
+    """
+        Runs capture, vision and control each in their own thread connected by slots that only keep
+        the latest value. The display consumes the latest result without ever blocking the control.
+    """
+
+    # The capture stage is woken up by every new frame of the camera instead of polling it, which
+    # would delay the frames by up to a frame period. Offline sources are read at the frame rate.
+    lastFrameSequence = 0
+    def capture():
+        nonlocal lastFrameSequence
+        captured = camera.waitFrame(lastFrameSequence, timeout=0.1)
+        if captured is None or captured[0] is None:
+            return None
+        lastFrameSequence = captured[1]
+        return captured
+
+    # Create the stages.
+    frames = LatestSlot()
+    detections = LatestSlot()
+    results = LatestSlot()
+    stages = [Stage('capture', capture, outputSlot=frames, rate=None if camera.live else processor.frameRate)]
+    if pool:
+
+        # The vision stage is split in submitting the frames to the worker processes and collecting
+        # the lanes they found. The frames are passed as context for displaying them with the result.
+        def submit(captured):
+            pool.submit(captured[0], captured)
+            return None
+        def collect():
+            result = pool.collect(timeout=0.1)
+            if result is None:
+                return None
+            sequence, leftPoly, rightPoly, duration, (frame, frameSequence, captureTime) = result
+            return frame.copy(), leftPoly, rightPoly, (frameSequence, captureTime, time.monotonic())
+        stages.append(Stage('submit', submit, inputSlot=frames))
+        stages.append(Stage('collect', collect, outputSlot=detections))
+    else:
+
+        # The output is copied since the display draws on it while the vision stage keeps
+        # processing frames into the ring of output buffers of the processor.
+        def vision(captured):
+            out, leftPoly, rightPoly, stamp = detect(captured)
+            return out.copy(), leftPoly, rightPoly, stamp
+        stages.append(Stage('vision', vision, inputSlot=frames, outputSlot=detections))
+    stages.append(Stage('control', control, inputSlot=detections, outputSlot=results))
+
+    # Start the stages.
+    for stage in stages:
+        stage.start()
+
+    # Display the latest result and report the stage statistics every few seconds.
+    lastSequence = 0
+    statsTime = time.time()
+    try:
+        while True:
+            item = results.get(lastSequence, timeout=0.1)
+            if item:
+                result, lastSequence, timestamp = item
+                if not render(result):
+                    break
+            elif not handleKeys():
+                break
+            if time.time() - statsTime > 5.0:
+                for stage in stages:
+                    s = stage.stats()
+                    print('%s: %.1f fps, age %.1f ms (max %.1f ms), dropped %d' % (stage.name, s['fps'], s['age'], s['maxAge'], s.get('dropped', 0)))
+                if pool:
+                    print('workers: submitted %d, dropped %d, stale %d' % (pool.submitted, pool.dropped, pool.stale))
+                if car.acks:
+                    print('latency: %s' % (car.latency.logLine()))
+                statsTime = time.time()
+    finally:
+
+        # The stages are joined before main() releases the camera, the recorder and the workers
+        # they use.
+        for stage in stages:
+            stage.stop.set()
+        for stage in stages:
+            stage.join(1.0)
+            if stage.is_alive():
+                print('%s stage did not stop' % (stage.name))
+
+def main():
+
+    try:
+        if args.pipelined or pool:
+            runPipelined()
+        else:
+            runSequential()
+    finally:
+
+        # Close communications with the camera and car, even when a stage failed.
+        # Close allw windows.
+        controller.stop.set()
+        car.shutdown()
+        if car.acks:
+            print('Glass to wheel latency p50/p95 ms: %s' % (car.latency.logLine()))
+        camera.stop()
+        if recorder:
+            recorder.close()
+        if pool:
+            pool.stop()
+        if preview:
+            preview.close()
+        else:
+            cv2.destroyAllWindows()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from collections import deque
+import threading
+import time
+
+class LatestSlot():
+    """
+        Connects two pipeline stages. Holds only the most recent value: put() never blocks and
+        overwrites any value that was not consumed yet, so stale data is dropped instead of queued.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.value = None
+        self.timestamp = 0
+        self.sequence = 0
+        self.consumed = 0
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, value):
+        """
+            Publishes a new value and wakes up any waiting consumer.
+        """
+        with self.condition:
+            if self.sequence > self.consumed:
+                self.dropped += 1
+            self.value = value
+            self.timestamp = time.perf_counter()
+            self.sequence += 1
+            self.condition.notify_all()
+
+    def get(self, lastSequence=0, timeout=None):
+        """
+            Waits for a value newer than lastSequence. Returns the tuple (value, sequence, timestamp)
+            or None if the timeout expires or the slot is closed.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sequence > lastSequence or self.closed, timeout):
+                return None
+            if self.sequence <= lastSequence:
+                return None
+            self.consumed = self.sequence
+            return self.value, self.sequence, self.timestamp
+
+    def close(self):
+        """
+            Wakes up all consumers so that they can finish.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class Stage(threading.Thread):
+    """
+        Pipeline stage running in its own thread. Takes the latest value of the input slot, passes it
+        to the function and publishes the result in the output slot. A stage without an input slot is
+        a source and calls the function with no arguments, optionally at a fixed rate. Results that are
+        None are not published.
+    """
+
+    def __init__(self, name, function, inputSlot=None, outputSlot=None, rate=None, window=100):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.function = function
+        self.inputSlot = inputSlot
+        self.outputSlot = outputSlot
+        self.period = 1.0 / rate if rate else 0
+        self.stop = threading.Event()
+        self.times = deque(maxlen=window)
+        self.ages = deque(maxlen=window)
+
+    def run(self):
+        lastSequence = 0
+        nextTime = time.perf_counter()
+        while not self.stop.is_set():
+
+            # Wait for new data or for the next tick.
+            if self.inputSlot:
+                item = self.inputSlot.get(lastSequence, timeout=0.1)
+                if item is None:
+                    if self.inputSlot.closed:
+                        break
+                    continue
+                value, lastSequence, timestamp = item
+                self.ages.append(time.perf_counter() - timestamp)
+                result = self.function(value)
+            else:
+                if self.period:
+                    nextTime += self.period
+                    delay = nextTime - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    else:
+                        nextTime = time.perf_counter()
+                result = self.function()
+
+            # Publish the result.
+            self.times.append(time.perf_counter())
+            if result is not None and self.outputSlot:
+                self.outputSlot.put(result)
+
+        if self.outputSlot:
+            self.outputSlot.close()
+
+    def stats(self):
+        """
+            Returns the throughput of the stage and the average and maximum age of the consumed data in ms.
+        """
+        times = list(self.times)
+        ages = list(self.ages)
+        stats = {
+            'fps': (len(times) - 1) / (times[-1] - times[0]) if len(times) > 1 and times[-1] > times[0] else 0.0,
+            'age': 1000 * sum(ages) / len(ages) if ages else 0.0,
+            'maxAge': 1000 * max(ages) if ages else 0.0
+        }
+        if self.outputSlot:
+            stats['dropped'] = self.outputSlot.dropped
+        return stats
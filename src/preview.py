@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+import collections
+import threading
+import time
+import cv2
+
+# Page with the stream that forwards the key presses of the viewer.
+PAGE = b'''<!DOCTYPE html>
+<html>
+<head><title>Lane keeping</title></head>
+<body style="margin: 0; background: #000;">
+<img src="/stream.mjpg" style="display: block; margin: auto;">
+<script>
+document.addEventListener('keydown', function(event) {
+    if (event.key.length == 1) {
+        fetch('/key?k=' + encodeURIComponent(event.key));
+        event.preventDefault();
+    }
+});
+</script>
+</body>
+</html>
+'''
+
+class PreviewHandler(BaseHTTPRequestHandler):
+    """
+        Serves the page, the MJPEG stream and the key presses of a preview server.
+    """
+
+    def do_GET(self):
+        preview = self.server.preview
+        url = urlparse(self.path)
+        if url.path == '/':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(PAGE)))
+            self.end_headers()
+            self.wfile.write(PAGE)
+        elif url.path == '/stream.mjpg':
+            self.send_response(200)
+            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            preview.addViewer(1)
+            try:
+                sequence = 0
+                while not preview.stop.is_set():
+                    jpeg, sequence = preview.waitFrame(sequence, timeout=1.0)
+                    if jpeg is None:
+                        continue
+                    self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % (len(jpeg)))
+                    self.wfile.write(jpeg)
+                    self.wfile.write(b'\r\n')
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                preview.addViewer(-1)
+        elif url.path == '/key':
+            key = parse_qs(url.query).get('k', [''])[0]
+            if len(key) == 1:
+                preview.pending.append(ord(key))
+            self.send_response(204)
+            self.end_headers()
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class PreviewServer(threading.Thread):
+    """
+        Headless replacement for the preview window. The frames published by the program are served
+        as an MJPEG stream over HTTP and the key presses of the viewers arrive on the same port, at
+        /key?k=<key>. Frames are only wanted while someone is watching and at a reduced rate, so the
+        overlays only need to be drawn for those frames. They are encoded by this thread, so
+        publishing a frame or reading the keys never blocks the caller.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8080, rate=5, quality=70):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = 1.0 / rate
+        self.quality = quality
+        self.stop = threading.Event()
+        self.condition = threading.Condition()
+
+        # Latest published frame waiting to be encoded and the latest encoded frame.
+        self.frame = None
+        self.jpeg = None
+        self.sequence = 0
+        self.lastPublish = 0
+        self.viewers = 0
+
+        # Key presses not read yet.
+        self.pending = collections.deque(maxlen=32)
+
+        self.httpServer = ThreadingServer((host, port), PreviewHandler)
+        self.httpServer.preview = self
+        self.address = self.httpServer.server_address
+
+    def run(self):
+        threading.Thread(target=self.httpServer.serve_forever, daemon=True).start()
+        while not self.stop.is_set():
+            with self.condition:
+                if self.frame is None:
+                    self.condition.wait(0.5)
+                frame, self.frame = self.frame, None
+            if frame is None:
+                continue
+            ok, jpeg = cv2.imencode('.jpg', frame, (cv2.IMWRITE_JPEG_QUALITY, self.quality))
+            if ok:
+                with self.condition:
+                    self.jpeg = jpeg.tobytes()
+                    self.sequence += 1
+                    self.condition.notify_all()
+
+    def due(self):
+        """
+            Checks if a frame is wanted: someone is watching and the last frame was published at
+            least one interval ago.
+        """
+        return self.viewers > 0 and time.monotonic() - self.lastPublish >= self.interval
+
+    def publish(self, frame):
+        """
+            Passes a frame to the encoder. The frame is copied, since the caller keeps using it.
+        """
+        with self.condition:
+            self.frame = frame.copy()
+            self.lastPublish = time.monotonic()
+            self.condition.notify_all()
+
+    def keys(self):
+        """
+            Returns the key codes received since the last call.
+        """
+        keys = []
+        while self.pending:
+            keys.append(self.pending.popleft())
+        return keys
+
+    def addViewer(self, count):
+        with self.condition:
+            self.viewers += count
+
+    def waitFrame(self, sequence, timeout=None):
+        """
+            Waits for an encoded frame newer than sequence. Returns the JPEG and its sequence or None
+            on timeout.
+        """
+        with self.condition:
+            if self.sequence == sequence:
+                self.condition.wait(timeout)
+            if self.sequence == sequence or self.jpeg is None:
+                return None, sequence
+            return self.jpeg, self.sequence
+
+    def close(self):
+        self.stop.set()
+        with self.condition:
+            self.condition.notify_all()
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
@@ -2,15 +2,60 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+import hashlib
 import cv2
+import os
 from line import Line
+from engines import ENGINES
+from cache import makeKey
+
+# Directory where the rectify maps are cached between runs.
+MAP_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'lane-keeping')
+
+def rectifyMaps(cameraMatrix, distortionCoefficients, newCameraMatrix, size, cache=MAP_CACHE):
+    """
+        Returns the rectify maps of a calibration and resolution in the fixed point CV_16SC2 format:
+        the integer coordinates and the interpolation table. The maps are cached in a directory under
+        a hash of the calibration and resolution, and memory mapped from there once they exist.
+        Without a cache directory they are always calculated.
+    """
+
+    if not cache:
+        return cv2.initUndistortRectifyMap(cameraMatrix, distortionCoefficients, None, newCameraMatrix, size, cv2.CV_16SC2)
+
+    key = hashlib.sha1()
+    for array in (cameraMatrix, distortionCoefficients, newCameraMatrix, size):
+        key.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    paths = [os.path.join(cache, 'rectify-%dx%d-%s-%s.npy' % (size[0], size[1], key.hexdigest()[:16], name)) for name in ('xy', 'table')]
+    try:
+        return tuple(np.load(path, mmap_mode='r') for path in paths)
+    except (OSError, ValueError):
+        pass
+
+    # Every file is written under a temporary name and renamed, so that a partial file is never loaded.
+    maps = cv2.initUndistortRectifyMap(cameraMatrix, distortionCoefficients, None, newCameraMatrix, size, cv2.CV_16SC2)
+    try:
+        os.makedirs(cache, exist_ok=True)
+        for path, array in zip(paths, maps):
+            temporary = '%s.%d.tmp' % (path, os.getpid())
+            with open(temporary, 'wb') as f:
+                np.save(f, array)
+            os.replace(temporary, path)
+    except OSError as e:
+        print('Rectify maps cant be cached: %s' % (e))
+    return maps
 
 class ImageProcessor():
     """
-        Implements the computer vision algorithms for detecting lanes in an image.
+        Implements the computer vision algorithms for detecting lanes in an image. The lanes are found
+        in the edges of the ROI by one of the engines of the engines module. The images of every stage
+        are written into working buffers owned by the processor, so that a frame doesn't allocate new
+        images once the buffers exist. The frame returned by process() is one of a ring of output
+        buffers and stays valid until outputCount more frames are processed. Another thread that
+        keeps it, e.g. the display of the pipelined mode, must copy it.
     """
 
-    def __init__(self, frameDimensions, frameRate):
+    def __init__(self, frameDimensions, frameRate, profiler=None, roiOnly=False, corridors=False, engine='hough', scale=1, scaleMethod='pyrDown', mapCache=MAP_CACHE, cache=None):
 
         # Define camera dimensions.
         self.frameDimensions = frameDimensions
@@ -43,64 +88,306 @@ class ImageProcessor():
         ])
         self.distortionCoefficients = np.array([[0.18541226, -0.32660915, 0.00088513, -0.00038131, -0.02052374]])
         self.newCameraMatrix, self.roi = cv2.getOptimalNewCameraMatrix(self.cameraMatrix, self.distortionCoefficients, self.frameDimensions, 1, self.frameDimensions)
-        self.rectifyMapX, self.rectifyMapY = cv2.initUndistortRectifyMap(self.cameraMatrix, self.distortionCoefficients, None, self.newCameraMatrix, self.frameDimensions, 5)
 
-    def doBlur(self, frame, iterations, kernelSize):
+        # Rectify maps in the fixed point format, loaded from the cache directory when possible.
+        # rectifyMapX holds the integer coordinates and rectifyMapY the interpolation table.
+        self.mapCache = mapCache
+        self.rectifyMapX, self.rectifyMapY = rectifyMaps(self.cameraMatrix, self.distortionCoefficients, self.newCameraMatrix, self.frameDimensions, mapCache)
+        self.scaledMaps = {1: (self.rectifyMapX, self.rectifyMapY)}
+
+        # Optional StageProfiler for timing every stage of the pipeline.
+        self.profiler = profiler
+
+        # Working buffers by name, the static ROI masks by geometry and the ring of output frames.
+        self.buffers = {}
+        self.allocations = 0
+        self.roiMasks = {}
+        self.outputCount = 3
+        self.outputIndex = 0
+
+        # Optional StageCache of the edges and the lane search, for offline replay and tuning.
+        self.cache = cache
+
+        # Blur settings.
+        self.blurIterations = 3
+        self.blurKernelSize = 7
+
+        # Canny and Hough settings. The Hough threshold and lengths are given at full resolution.
+        self.cannyThresholds = (20, 40)
+        self.houghThreshold = 20
+        self.houghMinLineLength = 5
+        self.houghMaxLineGap = 60
+
+        # Segments with a smaller angle in degrees are not assigned to any lane.
+        self.minAngle = 10
+
+        # The frame is processed at 1 / scale of its resolution. Must be a power of 2. With the 'pyrDown'
+        # method the gray frame is reduced after undistorting it at full resolution, with 'remap' the
+        # frame is undistorted directly into the reduced resolution. The lanes are always fitted in
+        # full resolution coordinates.
+        self.scale = scale
+        self.scaleMethod = scaleMethod
+
+        # Draws the segments of every lane on the output frame.
+        self.drawAll = True
+
+        # Engine that finds the lanes in the edges of the ROI: 'hough' or 'histogram'.
+        self.engine = ENGINES[engine](self)
+
+        # When roiOnly is set, every stage is run only on the horizontal band of the ROI.
+        self.roiOnly = roiOnly
+        self.createBand()
+
+        # When corridors is set, the Hough transform only runs in a corridor around the predicted
+        # position of each lane. The width of a corridor is a multiple (corridorSigmas) of the
+        # standard deviation of the prediction, limited to corridorWidth px on each side. The full
+        # ROI is used until both lanes are found and once a lane is lost for corridorLostFrames.
+        self.corridors = corridors
+        self.corridorSigmas = 0.5
+        self.corridorWidth = (20, 60)
+        self.corridorLostFrames = 5
+        self.lostFrames = [self.corridorLostFrames, self.corridorLostFrames]
+        self.prediction = None
+
+    def createBand(self):
+        """
+            Calculates the rows of the ROI band and crops the rectify maps to them. The band has an
+            extra margin so that the blur and Canny produce the same edges as on the full frame.
+        """
+
+        # The rows of the band are multiples of the scale so that it is reduced exactly.
+        scale = self.scale
+        margin = (self.blurIterations * (self.blurKernelSize // 2) + 2) * scale
+        self.bandY0 = max(int(self.h * self.roiY[0]) - margin, 0) // scale * scale
+        self.bandY1 = min(-(-(int(self.h * self.roiY[1]) + margin + 1) // scale) * scale, self.h)
+        if self.scaleMethod == 'remap':
+            mapX, mapY = self.getScaledMaps(scale)
+            self.bandMapX = mapX[self.bandY0 // scale:self.bandY1 // scale]
+            self.bandMapY = mapY[self.bandY0 // scale:self.bandY1 // scale]
+        else:
+            self.bandMapX = self.rectifyMapX[self.bandY0:self.bandY1]
+            self.bandMapY = self.rectifyMapY[self.bandY0:self.bandY1]
+
+    def getScaledMaps(self, scale):
+        """
+            Returns the rectify maps that undistort a frame directly into 1 / scale of its resolution.
+            A pixel of the reduced frame is the pixel of the full frame at scale times its coordinates.
+        """
+
+        if scale not in self.scaledMaps:
+            newCameraMatrix = self.newCameraMatrix.copy()
+            newCameraMatrix[:2] /= scale
+            self.scaledMaps[scale] = rectifyMaps(self.cameraMatrix, self.distortionCoefficients, newCameraMatrix, (self.w // scale, self.h // scale), self.mapCache)
+        return self.scaledMaps[scale]
+
+    def getBuffer(self, name, shape, dtype=np.uint8):
+        """
+            Returns a working buffer. It is allocated on first use and again only when its shape
+            changes, e.g. with the scale. The number of allocations is counted in allocations.
+        """
+
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self.buffers[name] = np.zeros(shape, dtype)
+            self.allocations += 1
+        return buffer
+
+    def setQuality(self, **settings):
+        """
+            Changes the processing settings, e.g. blurIterations, scale, houghThreshold or drawAll.
+        """
+
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise AttributeError('unknown setting: %s' % (name))
+            setattr(self, name, value)
+        self.createBand()
+
+    def setPrediction(self, leftPoly, rightPoly, leftSigma, rightSigma):
+        """
+            Sets the predicted lanes for the next frame and the standard deviation of their -x position
+            at the top and bottom rows of the ROI, as returned by LaneTracker.prediction. The polygons
+            of the corridors around them are calculated in full frame coordinates.
+        """
+
+        y0 = self.h * self.roiY[0]
+        y1 = self.h * self.roiY[1]
+        corridors = np.zeros((2, 4, 2))
+        for corridor, poly, sigma in zip(corridors, (leftPoly, rightPoly), (leftSigma, rightSigma)):
+            m, b = poly.coeffs if poly.order == 1 else (0, poly.coeffs[-1])
+            w0, w1 = np.clip(self.corridorSigmas * np.asarray(sigma), *self.corridorWidth)
+            x0 = m * y0 + b
+            x1 = m * y1 + b
+            corridor[:] = [
+                (x0 - w0, y0),
+                (x1 - w1, y1),
+                (x1 + w1, y1),
+                (x0 + w0, y0)
+            ]
+        self.prediction = corridors
+
+    def getCorridors(self):
         """
-            Performs a gaussian blur with the set number of iterations.
+            Returns the polygons of the corridors around the predicted lanes or None when the full ROI
+            must be used.
         """
 
-        blured = frame.copy()
-        while iterations > 0:
-            blured =  cv2.GaussianBlur(blured, (kernelSize, kernelSize), sigmaX=0, sigmaY=0)
-            iterations -= 1
+        if not self.corridors or max(self.lostFrames) >= self.corridorLostFrames:
+            return None
+        return self.prediction
+
+    def doScale(self, frame, scale, dst=None):
+        """
+            Reduces the resolution of a frame by halving it until it is 1 / scale of the original. With
+            dst, the result is written into it and the intermediate levels into working buffers.
+        """
+
+        while scale > 1:
+            level = None
+            if dst is not None:
+                level = dst if scale == 2 else self.getBuffer('pyrDown%d' % (scale), ((frame.shape[0] + 1) // 2, (frame.shape[1] + 1) // 2))
+            frame = cv2.pyrDown(frame, dst=level)
+            scale //= 2
+        return frame
+
+    def doBlur(self, frame, iterations, kernelSize, dst=None):
+        """
+            Performs a gaussian blur with the set number of iterations. Every iteration after the
+            first one blurs in place. With dst, the result is written into it.
+        """
+
+        if iterations <= 0:
+            if dst is None:
+                return frame.copy()
+            np.copyto(dst, frame)
+            return dst
+        blured = cv2.GaussianBlur(frame, (kernelSize, kernelSize), sigmaX=0, sigmaY=0, dst=dst)
+        for i in range(iterations - 1):
+            cv2.GaussianBlur(blured, (kernelSize, kernelSize), sigmaX=0, sigmaY=0, dst=blured)
         return blured
 
-    def doRegionOfInterest(self, frame):
+    def doRegionOfInterest(self, frame, offsetY=0, scale=1, corridors=None, dst=None):
         """
             Obtains the region of interest from a frame. The dimensions of the ROI are set by the class
-            properties roiX and roiY.
+            properties roiX and roiY. offsetY is the row of the full frame where the frame starts and
+            scale the reduction of the frame resolution. When corridors are given, only the part of
+            the ROI inside them is kept. The mask of the ROI is built once for every geometry, the
+            mask of the corridors is drawn into a working buffer. With dst, the result is written into it.
         """
 
-        y0Px = self.h * self.roiY[0]
-        y1Px = self.h * self.roiY[1]
+        y0Px = self.h * self.roiY[0] - offsetY
+        y1Px = self.h * self.roiY[1] - offsetY
         x0Px = (1 - self.roiX[0]) * self.w / 2
         x1Px = (1 - self.roiX[1]) * self.w / 2
-        vertices = np.array([[
-            (x0Px, y0Px),
-            (x1Px, y1Px),
-            (self.w - x1Px, y1Px),
-            (self.w - x0Px, y0Px)
-        ]], dtype=np.int32)
-        mask = np.zeros_like(frame)
-        cv2.fillPoly(mask, vertices, 255)
-        return cv2.bitwise_and(frame, mask)
+        if corridors is None:
+            key = (frame.shape, offsetY, scale, self.roiX, self.roiY)
+            mask = self.roiMasks.get(key)
+            if mask is None:
+                vertices = np.array([[
+                    (x0Px, y0Px),
+                    (x1Px, y1Px),
+                    (self.w - x1Px, y1Px),
+                    (self.w - x0Px, y0Px)
+                ]]) / scale
+                mask = np.zeros_like(frame)
+                cv2.fillPoly(mask, vertices.astype(np.int32), 255)
+                self.roiMasks[key] = mask
+        else:
+            # The corridors span the rows of the ROI, so only the parts outside its sides are cleared.
+            mask = self.getBuffer('corridorMask', frame.shape)
+            mask[:] = 0
+            corridors = ((corridors - (0, offsetY)) / scale).astype(np.int32)
+            cv2.fillPoly(mask, corridors, 255)
+            outside = np.array([
+                [(0, y0Px), (x0Px, y0Px), (x1Px, y1Px), (0, y1Px)],
+                [(self.w, y0Px), (self.w - x0Px, y0Px), (self.w - x1Px, y1Px), (self.w, y1Px)]
+            ]) / scale
+            cv2.fillPoly(mask, outside.astype(np.int32), 0)
+        return cv2.bitwise_and(frame, mask, dst=dst)
+
+    def doSearch(self, small, offsetY=0):
+        """
+            Runs the blur, Canny, the ROI and the search of the engine on the reduced frame. With a
+            cache, the result of the search and the edges are looked up by the content of the ROI band
+            of the reduced frame and the settings of every stage before them, so only the stages after
+            a changed setting run again.
+        """
+
+        profiler = self.profiler
+        cache = self.cache
+        corridors = self.getCorridors() if self.engine.masked else None
+        if cache:
+            # Only the rows of the band have an effect on the edges of the ROI.
+            r0, r1 = (0, small.shape[0]) if self.roiOnly else (self.bandY0 // self.scale, self.bandY1 // self.scale)
+            edgesKey = makeKey('edges', small[r0:r1], small.shape, r0, self.scale, self.blurIterations, self.blurKernelSize, self.cannyThresholds)
+            searchKey = makeKey('search', edgesKey, type(self.engine).__name__, self.engine.parameters(), offsetY, self.roiX, self.roiY, corridors)
+            entry = cache.get(searchKey)
+            if entry is not None:
+                return self.engine.unpack(entry)
+            entry = cache.get(edgesKey)
+
+        if cache and entry is not None:
+            canny = self.getBuffer('canny', small.shape)
+            canny[:r0] = 0
+            canny[r1:] = 0
+            canny[r0:r1] = entry['edges']
+        else:
+            blured = self.doBlur(small, iterations=self.blurIterations, kernelSize=max(self.blurKernelSize // self.scale | 1, 3), dst=self.getBuffer('blured', small.shape))
+            if profiler:
+                profiler.mark('blur')
+            canny = cv2.Canny(blured, threshold1=self.cannyThresholds[0], threshold2=self.cannyThresholds[1], edges=self.getBuffer('canny', small.shape))
+            if profiler:
+                profiler.mark('canny')
+            if cache:
+                cache.put(edgesKey, {'edges': canny[r0:r1].copy()})
+        if self.engine.masked:
+            roi = self.doRegionOfInterest(canny, offsetY, self.scale, corridors, dst=self.getBuffer('roi', canny.shape))
+        else:
+            roi = canny
+        if profiler:
+            profiler.mark('roi')
+
+        # The search of every engine is recorded as the hough stage.
+        search = self.engine.search(roi, offsetY, self.scale)
+        if profiler:
+            profiler.mark('hough')
+        if cache:
+            cache.put(searchKey, self.engine.pack(search))
+        return search
 
     def findLanes(self, frame, lines, minAngle=10, drawAll=False):
         """
-            Iterates through the results from the Hough Transform and filters the detected lines into
-            those who belong to the left and right lane. Finally fits the data to a 1st order polynomial.
-        """
-
-        self.left.clear()
-        self.right.clear()
-        if type(lines) == type(np.array([])):
-            for line in lines:
-                for x1, y1, x2, y2 in line:
-                    angle = np.degrees(np.arctan2(y2 - y1, x2 - x1))
-                    if np.abs(angle) > minAngle:
-                        if angle > 0:
-                            self.right.add(x1, y1, x2, y2)
-                            if drawAll:
-                                cv2.line(frame, (x1, y1), (x2, y2), self.right.color)
-                        else:
-                            self.left.add(x1, y1, x2, y2)
-                            if drawAll:
-                                cv2.line(frame, (x1, y1), (x2, y2), self.left.color)
+            Filters the results from the Hough Transform into those who belong to the left and right lane.
+            The angles of all segments are calculated at once and the lanes are split with boolean masks.
+            Finally fits the data to a 1st order polynomial.
+        """
+
+        if isinstance(lines, np.ndarray) and lines.size:
+            segments = lines.reshape(-1, 4)
+            angles = np.degrees(np.arctan2(segments[:, 3] - segments[:, 1], segments[:, 2] - segments[:, 0]))
+            valid = np.abs(angles) > minAngle
+            isRight = angles > 0
+            self.right.set(segments[valid & isRight])
+            self.left.set(segments[valid & ~isRight])
+        else:
+            self.left.clear()
+            self.right.clear()
         self.left.fit()
         self.right.fit()
+        if drawAll:
+            self.drawSegments(frame)
         return frame
-        
+
+    def drawSegments(self, frame):
+        """
+            Draws the segments that were assigned to each lane.
+        """
+
+        for line in (self.left, self.right):
+            if len(line.segments):
+                cv2.polylines(frame, line.segments.reshape(-1, 2, 2), False, line.color)
+        return frame
+
     def drawPoly(self, frame, poly, color, width=3):
         """
             Draws a 1-D polynomial into the frame. Uses the roiY for the -y coordinates.
@@ -117,28 +404,140 @@ class ImageProcessor():
         else:
             cv2.line(frame, (0, y0Px), (0, y1Px), color, width)     
 
-    def process(self, frame):
-        """
-            Main pipeline for detecting lanes on a frame.
-        """
-
-        undistort = cv2.remap(frame, self.rectifyMapX, self.rectifyMapY, cv2.INTER_LINEAR)
-        gray = cv2.cvtColor(undistort, cv2.COLOR_BGR2GRAY)
-        grayColor = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
-        blured = self.doBlur(gray, iterations=3, kernelSize=7)
-        canny = cv2.Canny(blured, threshold1=20, threshold2=40)
-        roi = self.doRegionOfInterest(canny)
-        houghLines = cv2.HoughLinesP(
-            roi,
-            rho = 1, 
-            theta = np.pi / 180, 
-            threshold = 20, 
-            lines = np.array([]), 
-            minLineLength = 5, 
-            maxLineGap = 60
-        )
-        lanes = self.findLanes(grayColor, houghLines, minAngle=10, drawAll=True)
+    def process(self, frame, draw=True):
+        """
+            Main pipeline for detecting lanes on a frame. Without draw, the segments are not drawn even
+            with drawAll, e.g. for frames nobody sees.
+        """
+
+        profiler = self.profiler
+        if profiler:
+            profiler.start()
+        # In ROI only mode all stages run on the band and the output frame is blank outside of it.
+        # With the remap scale method the frame is undistorted directly into the reduced resolution.
+        remapScaled = self.scaleMethod == 'remap' and self.scale > 1
+        if self.roiOnly:
+            offsetY = self.bandY0
+            mapX, mapY = self.bandMapX, self.bandMapY
+        else:
+            offsetY = 0
+            mapX, mapY = self.getScaledMaps(self.scale) if remapScaled else (self.rectifyMapX, self.rectifyMapY)
+        undistort = cv2.remap(frame, mapX, mapY, cv2.INTER_LINEAR, dst=self.getBuffer('undistort', mapX.shape[:2] + frame.shape[2:]))
+        if profiler:
+            profiler.mark('remap')
+        gray = cv2.cvtColor(undistort, cv2.COLOR_BGR2GRAY, dst=self.getBuffer('gray', undistort.shape[:2]))
+
+        # The output frame is always at full resolution.
+        if remapScaled:
+            small = gray
+            gray = cv2.resize(small, (self.w, small.shape[0] * self.scale), dst=self.getBuffer('grayFull', (small.shape[0] * self.scale, self.w)), interpolation=cv2.INTER_LINEAR)
+        else:
+            h, w = gray.shape
+            scale = self.scale
+            while scale > 1:
+                h, w = (h + 1) // 2, (w + 1) // 2
+                scale //= 2
+            small = self.doScale(gray, self.scale, dst=self.getBuffer('small', (h, w)) if self.scale > 1 else None)
+
+        # In ROI only mode the rows outside the band are cleared, since the caller may have drawn on them.
+        grayColor = self.getBuffer('output%d' % (self.outputIndex), (self.h, self.w, 3))
+        self.outputIndex = (self.outputIndex + 1) % self.outputCount
+        if self.roiOnly:
+            grayColor[:self.bandY0] = 0
+            grayColor[self.bandY1:] = 0
+            cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR, grayColor[self.bandY0:self.bandY1])
+        else:
+            cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR, grayColor)
+        if profiler:
+            profiler.mark('gray')
+        search = self.doSearch(small, offsetY)
+        lanes = self.engine.lanes(grayColor, search, drawAll=self.drawAll and draw)
+        for i, line in enumerate((self.left, self.right)):
+            self.lostFrames[i] = 0 if line.poly else self.lostFrames[i] + 1
+        if profiler:
+            profiler.mark('lanes')
+            profiler.end()
         # self.drawPoly(lanes, self.left.poly, self.left.color, width=3)
         # self.drawPoly(lanes, self.right.poly, self.right.color, width=3)
 
-        return grayColor
\ No newline at end of file
+        return grayColor
+if __name__ == '__main__':
+
+    """
+        Small test that compares the reduced resolutions against the full resolution. The frames are
+        rendered by the simulator with known lanes at different positions of the vehicle. Then checks
+        that frames in the steady state allocate no new images in every mode of the processor.
+    """
+    from simulator import SceneRenderer, Vehicle
+    from tracker import LaneTracker
+    import itertools
+    import tracemalloc
+    import time
+
+    frameDimensions = (480, 320)
+    renderer = SceneRenderer(ImageProcessor(frameDimensions, 20), noise=8, seed=0)
+    scenes = []
+    for lateral in np.linspace(-0.08, 0.08, 5):
+        for heading in (-0.1, 0, 0.1):
+            left, right = Vehicle(lateral=lateral, heading=heading).lanes(h=frameDimensions[1])
+            scenes.append((renderer.render(left, right), left, right))
+
+    print('%-10s %-7s %-8s %9s %11s %9s %10s' % ('engine', 'scale', 'method', 'error px', 'vs full px', 'lost %', 'time ms'))
+    for engine, scale, method in itertools.product(('hough', 'histogram'), (1, 2, 4), ('pyrDown', 'remap')):
+        if scale == 1 and method == 'remap':
+            continue
+        processor = ImageProcessor(frameDimensions, 20, engine=engine, scale=scale, scaleMethod=method)
+        rows = (processor.h * processor.roiY[0], processor.h * processor.roiY[1])
+        fits = np.full((len(scenes), 2, 2), np.nan)
+        errors = []
+        t0 = time.perf_counter()
+        for repeat in range(10):
+            for frame, left, right in scenes:
+                processor.process(frame)
+        duration = (time.perf_counter() - t0) / (10 * len(scenes))
+        for n, (frame, left, right) in enumerate(scenes):
+            processor.process(frame)
+            for lane, (line, truth) in enumerate(((processor.left, left), (processor.right, right))):
+                if line.poly:
+                    fits[n, lane] = line.poly(rows)
+                    errors.append(np.mean(np.abs(line.poly(rows) - truth(rows))))
+        if scale == 1:
+            reference = fits
+        print('%-10s %-7s %-8s %9.2f %11.2f %9.1f %10.2f' % (
+            engine, '1/%d' % (scale), method, np.mean(errors), np.nanmean(np.abs(fits - reference)),
+            100 * np.mean(np.isnan(fits[:, :, 0])), duration * 1000
+        ))
+
+    # Once the working buffers exist, the memory allocated while processing a frame must stay below the
+    # size of the smallest image of the pipeline, the edges at the processing resolution.
+    print()
+    print('%-40s %12s %14s %10s' % ('options', 'allocations', 'peak bytes', 'limit'))
+    for options in (
+        {},
+        {'roiOnly': True},
+        {'scale': 2},
+        {'scale': 4, 'scaleMethod': 'remap'},
+        {'roiOnly': True, 'scale': 2},
+        {'corridors': True},
+        {'engine': 'histogram'}
+    ):
+        processor = ImageProcessor(frameDimensions, 20, **options)
+        tracker = LaneTracker()
+        rows = (processor.h * processor.roiY[0], processor.h * processor.roiY[1])
+        def step(frame):
+            processor.process(frame)
+            tracker.add(processor.left.poly, processor.right.poly)
+            if processor.corridors:
+                processor.setPrediction(*tracker.prediction(rows))
+        for frame, left, right in scenes:
+            step(frame)
+        allocations = processor.allocations
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        for frame, left, right in scenes:
+            step(frame)
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+        limit = processor.buffers['canny'].nbytes
+        print('%-40s %12d %14d %10d' % (options, processor.allocations - allocations, peak, limit))
+        assert processor.allocations == allocations and peak < limit, 'steady state frames allocate images'
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import time
+import cv2
+
+class StageProfiler():
+    """
+        Keeps the duration of the last frames for every stage of a pipeline in a ring buffer
+        and calculates rolling percentiles from them. A frame is timed by calling start() once,
+        mark() after every stage and end() when the frame is done.
+    """
+
+    def __init__(self, size=200, logInterval=None):
+        self.size = size
+        self.logInterval = logInterval
+        self.buffers = {}
+        self.counts = {}
+        self.frameStart = 0
+        self.lastMark = 0
+        self.lastLog = time.perf_counter()
+
+    def start(self):
+        """
+            Marks the beginning of a frame.
+        """
+        self.frameStart = self.lastMark = time.perf_counter()
+
+    def mark(self, stage):
+        """
+            Records the time elapsed since the previous mark as the duration of a stage.
+        """
+        now = time.perf_counter()
+        self.record(stage, now - self.lastMark)
+        self.lastMark = now
+
+    def end(self):
+        """
+            Records the duration of the whole frame and writes the log line if it is due.
+        """
+        now = time.perf_counter()
+        self.record('total', now - self.frameStart)
+        if self.logInterval and now - self.lastLog > self.logInterval:
+            print(self.logLine())
+            self.lastLog = now
+
+    def record(self, stage, seconds):
+        """
+            Stores a duration in the ring buffer of a stage.
+        """
+        buffer = self.buffers.get(stage)
+        if buffer is None:
+            buffer = self.buffers[stage] = np.zeros(self.size)
+            self.counts[stage] = 0
+        buffer[self.counts[stage] % self.size] = seconds
+        self.counts[stage] += 1
+
+    def stats(self):
+        """
+            Returns for every stage the last duration and the rolling p50, p95 and p99 in ms.
+        """
+        stats = {}
+        for stage, buffer in self.buffers.items():
+            count = self.counts[stage]
+            if count == 0:
+                continue
+            samples = buffer[:min(count, self.size)] * 1000
+            p50, p95, p99 = np.percentile(samples, (50, 95, 99))
+            stats[stage] = {
+                'last': buffer[(count - 1) % self.size] * 1000,
+                'p50': p50,
+                'p95': p95,
+                'p99': p99
+            }
+        return stats
+
+    def last(self, stage):
+        """
+            Returns the last duration of a stage in ms or NaN if it was never recorded.
+        """
+        count = self.counts.get(stage, 0)
+        if count == 0:
+            return np.nan
+        return self.buffers[stage][(count - 1) % self.size] * 1000
+
+    def logLine(self):
+        """
+            Formats the p50/p95 of every stage into a single line.
+        """
+        return ' | '.join('%s %.1f/%.1f' % (stage, s['p50'], s['p95']) for stage, s in self.stats().items())
+
+    def draw(self, frame, x=10, y=70):
+        """
+            Writes the p50/p95/p99 of every stage on a frame.
+        """
+        for stage, s in self.stats().items():
+            cv2.putText(frame, '%s %.1f %.1f %.1f' % (stage, s['p50'], s['p95'], s['p99']), (x, y), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 255), 1)
+            y += 15
+        return frame
+
+    def reset(self):
+        """
+            Clears all recorded durations.
+        """
+        self.buffers = {}
+        self.counts = {}
+
+class StartupReport():
+    """
+        Measures how long every step of the startup takes. mark() is called at the end of every step
+        and report() formats the duration of the steps and the total since the start.
+    """
+
+    def __init__(self, start=None):
+        self.start = self.lastMark = time.perf_counter() if start is None else start
+        self.steps = []
+
+    def mark(self, step):
+        """
+            Records the time elapsed since the previous mark as the duration of a step.
+        """
+        now = time.perf_counter()
+        self.steps.append((step, now - self.lastMark))
+        self.lastMark = now
+
+    def report(self):
+        """
+            Formats the duration of every step in ms, one per line, followed by the total.
+        """
+        lines = ['%-12s %8.1f ms' % (step, duration * 1000) for step, duration in self.steps]
+        lines.append('%-12s %8.1f ms' % ('total', (self.lastMark - self.start) * 1000))
+        return '\n'.join(lines)
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+    Binary protocol between the RPI and the STM32. Every frame has a fixed size that depends on its
+    type and is made of:
+
+        SYNC (0xAA) | TYPE | PAYLOAD | CHECKSUM
+
+    The checksum is the XOR of the type and the payload bytes. The sync byte is never part of the
+    text protocol, so the STM32 can accept text and binary commands at the same time.
+"""
+
+import struct
+
+SYNC = 0xAA
+
+# Frame types sent by the RPI.
+VEL = 0x01                                  # Left and right motor speed in %.
+STATUS_REQUEST = 0x02                       # Requests a STATUS frame.
+SUBSCRIBE = 0x03                            # Interval in ms at which STATUS frames are pushed, 0 stops them.
+VEL_SEQ = 0x04                              # Like VEL followed by a sequence number that is acknowledged.
+
+# Frame types sent by the STM32.
+STATUS = 0x82                               # Battery voltages in mV, charges in % and shutdown flag.
+ACK = 0x84                                  # Sequence number of a VEL_SEQ and the time in ms it was received.
+
+# Payload format of every frame type.
+FORMATS = {
+    VEL: struct.Struct('<bb'),
+    STATUS_REQUEST: struct.Struct('<'),
+    SUBSCRIBE: struct.Struct('<H'),
+    VEL_SEQ: struct.Struct('<bbH'),
+    STATUS: struct.Struct('<HHHHBBB'),
+    ACK: struct.Struct('<HI')
+}
+
+def checksum(data):
+    """
+        Calculates the XOR of all bytes.
+    """
+    value = 0
+    for byte in data:
+        value ^= byte
+    return value
+
+def pack(frameType, *values):
+    """
+        Builds a complete frame of the given type.
+    """
+    body = bytes((frameType,)) + FORMATS[frameType].pack(*values)
+    return bytes((SYNC,)) + body + bytes((checksum(body),))
+
+def packVelocity(left, right, sequence=None):
+    """
+        Builds a VEL frame, or a VEL_SEQ frame when a sequence number is given. The speeds are
+        constrained to be within -100 and 100%.
+    """
+    left = max(-100, min(100, int(left)))
+    right = max(-100, min(100, int(right)))
+    if sequence is None:
+        return pack(VEL, left, right)
+    return pack(VEL_SEQ, left, right, sequence & 0xFFFF)
+
+def frameSize(frameType):
+    """
+        Returns the complete size of a frame of the given type.
+    """
+    return FORMATS[frameType].size + 3
+
+class FrameParser():
+    """
+        Incremental parser for binary frames. Bytes are fed as they arrive and complete frames are
+        returned as soon as they are available. Bytes that are not part of a valid frame are skipped.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.errors = 0
+
+    def feed(self, data):
+        """
+            Adds data to the buffer and returns a list with the (type, values) of every complete frame.
+        """
+        self.buffer.extend(data)
+        frames = []
+        while True:
+
+            # Look for the beginning of a frame.
+            start = self.buffer.find(SYNC)
+            if start < 0:
+                self.buffer.clear()
+                break
+            if start > 0:
+                del self.buffer[:start]
+            if len(self.buffer) < 2:
+                break
+
+            # Unknown types are skipped.
+            frameType = self.buffer[1]
+            if frameType not in FORMATS:
+                self.errors += 1
+                del self.buffer[0]
+                continue
+
+            # Wait until the whole frame arrived.
+            size = frameSize(frameType)
+            if len(self.buffer) < size:
+                break
+
+            # Check the integrity of the frame.
+            body = bytes(self.buffer[1:size - 1])
+            if checksum(body) != self.buffer[size - 1]:
+                self.errors += 1
+                del self.buffer[0]
+                continue
+            frames.append((frameType, FORMATS[frameType].unpack(body[1:])))
+            del self.buffer[:size]
+
+        return frames
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import threading
+import struct
+import time
+import ast
+
+# Stages of the image processor whose duration is recorded.
+STAGES = ('remap', 'gray', 'blur', 'canny', 'roi', 'hough', 'lanes', 'total')
+
+# Layout of a record. Values that are not available are NaN.
+RECORD = np.dtype([
+    ('time', 'f8'),                         # Monotonic time in s.
+    ('rawLeft', 'f4', (2,)),                # Coefficients of the detected lanes.
+    ('rawRight', 'f4', (2,)),
+    ('left', 'f4', (2,)),                   # Coefficients of the filtered lanes.
+    ('right', 'f4', (2,)),
+    ('leftError', 'f4'),                    # Errors in px.
+    ('rightError', 'f4'),
+    ('averageError', 'f4'),
+    ('p', 'f4'),                            # PID terms.
+    ('i', 'f4'),
+    ('d', 'f4'),
+    ('velLeft', 'f4'),                      # Wheel velocities in %.
+    ('velRight', 'f4'),
+    ('rpiBatteryVoltage', 'f4'),            # Battery status in v.
+    ('motorBatteryVoltage', 'f4'),
+    ('qualityLevel', 'f4'),                 # Quality level of the image processor.
+    ('stages', 'f4', (len(STAGES),))        # Duration of the image processor stages in ms.
+])
+
+# Every file starts with the magic, the length of the layout description and the description itself.
+MAGIC = b'LANEREC1'
+
+class Recorder(threading.Thread):
+    """
+        Records one fixed layout record per frame of the control loop. The records are written into
+        a preallocated ring buffer and appended to a file by a background thread, so that recording
+        costs the control loop only a few assignments. If the file can't keep up, the oldest records
+        that were not written yet are overwritten and counted as dropped.
+    """
+
+    def __init__(self, path, size=1024, flushInterval=1.0, dtype=RECORD):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.size = size
+        self.flushInterval = flushInterval
+        self.dtype = dtype
+        self.buffer = np.zeros(size, dtype)
+        self.empty = np.zeros((), dtype)
+        for name in dtype.names:
+            if dtype[name].base.kind == 'f':
+                self.empty[name] = np.nan
+        self.head = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+
+        # Write the header.
+        description = repr(dtype.descr).encode('ascii')
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC + struct.pack('<I', len(description)) + description)
+
+    def record(self, **values):
+        """
+            Appends a record. The time is added automatically if it is not given.
+        """
+        index = self.head % self.size
+        record = self.buffer[index:index + 1]
+        record[0] = self.empty
+        record['time'] = time.monotonic()
+        for name, value in values.items():
+            if value is not None:
+                record[name] = value
+        self.head += 1
+
+    def run(self):
+        while not self.stop.wait(self.flushInterval):
+            self.flush()
+
+    def flush(self):
+        """
+            Appends all new records to the file.
+        """
+        with self.lock:
+            head = self.head
+            if head - self.flushed > self.size:
+                self.dropped += head - self.flushed - self.size
+                self.flushed = head - self.size
+            while self.flushed < head:
+                start = self.flushed % self.size
+                end = min(start + head - self.flushed, self.size)
+                self.file.write(self.buffer[start:end].tobytes())
+                self.flushed += end - start
+            self.file.flush()
+
+    def close(self):
+        """
+            Stops the background thread, writes the remaining records and closes the file.
+        """
+        self.stop.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+        self.file.close()
+
+def load(path):
+    """
+        Loads a recording. Returns a dictionary with an array for every field of the records.
+    """
+
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a recording: %s' % (path))
+        length = struct.unpack('<I', f.read(4))[0]
+        dtype = np.dtype(ast.literal_eval(f.read(length).decode('ascii')))
+        offset = f.tell()
+    records = np.fromfile(path, dtype, offset=offset)
+    return {name: records[name] for name in dtype.names}
+
+if __name__ == '__main__':
+
+    """
+        Small test that prints the summary of a recording.
+    """
+    import sys
+    run = load(sys.argv[1])
+    count = len(run['time'])
+    print('Records: %d' % (count))
+    if count > 1:
+        print('Duration: %.1f s, %.1f records/s' % (run['time'][-1] - run['time'][0], (count - 1) / (run['time'][-1] - run['time'][0])))
+    if 'qualityLevel' in run and np.any(~np.isnan(run['qualityLevel'])):
+        levels, counts = np.unique(run['qualityLevel'][~np.isnan(run['qualityLevel'])], return_counts=True)
+        print('Quality levels: %s' % (', '.join('%d: %d' % (level, count) for level, count in zip(levels, counts))))
+    for name in ('leftError', 'rightError', 'averageError'):
+        if np.any(~np.isnan(run[name])):
+            print('%s: mean %.2f, std %.2f' % (name, np.nanmean(run[name]), np.nanstd(run[name])))
+    for i, stage in enumerate(STAGES):
+        if np.any(~np.isnan(run['stages'][:, i])):
+            print('%s: p50 %.2f ms, p99 %.2f ms' % (stage, np.nanpercentile(run['stages'][:, i], 50), np.nanpercentile(run['stages'][:, i], 99)))
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from processor import ImageProcessor
+from governor import QualityGovernor
+from profiler import StageProfiler
+from source import openSource
+from cache import StageCache
+from tracker import LaneTracker
+import numpy as np
+import argparse
+import time
+
+def summarize(latencies, elapsed):
+    """
+        Calculates the throughput and the per-frame latency percentiles (in ms) of a run.
+    """
+
+    latencies = np.asarray(latencies) * 1000
+    if len(latencies) == 0:
+        return {'frames': 0, 'fps': 0.0}
+    return {
+        'frames': len(latencies),
+        'fps': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'mean': float(np.mean(latencies)),
+        'p50': float(np.percentile(latencies, 50)),
+        'p90': float(np.percentile(latencies, 90)),
+        'p99': float(np.percentile(latencies, 99)),
+        'max': float(np.max(latencies))
+    }
+
+def replay(source, processor, rate=None, maxFrames=None, governor=None):
+    """
+        Drives the lane detection pipeline headless with the frames of a source. When rate is None
+        the frames are processed as fast as possible, otherwise they are paced to the given frame
+        rate. The optional governor adapts the quality to the processing time. Returns the
+        statistics of the run.
+    """
+
+    laneTracker = LaneTracker()
+    corridorRows = (processor.roiY[0] * processor.h, processor.roiY[1] * processor.h)
+    latencies = []
+    period = 1.0 / rate if rate else 0
+
+    source.start()
+    startTime = time.perf_counter()
+    nextTime = startTime
+    try:
+        while maxFrames is None or len(latencies) < maxFrames:
+
+            # 1. Reads frame from the source.
+            frame = source.read()
+            if frame is None:
+                break
+
+            # 2. Processes the frame and passes the found lanes to the Kalman Filter.
+            t0 = time.perf_counter()
+            processor.process(frame)
+            laneTracker.add(processor.left.poly, processor.right.poly)
+            if processor.corridors:
+                processor.setPrediction(*laneTracker.prediction(corridorRows))
+            latencies.append(time.perf_counter() - t0)
+            if governor:
+                governor.update(latencies[-1])
+
+            # 3. Waits for the next tick when simulating a fixed frame rate.
+            if period:
+                nextTime += period
+                delay = nextTime - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+    finally:
+        source.stop()
+
+    return summarize(latencies, time.perf_counter() - startTime)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Runs the lane detection pipeline on recorded frames.')
+    parser.add_argument('source', help='video file, directory of images or .npy frame stack')
+    parser.add_argument('--rate', type=float, default=None, help='simulated frame rate, default is as fast as possible')
+    parser.add_argument('--frames', type=int, default=None, help='maximum number of frames to process')
+    parser.add_argument('--loop', action='store_true', help='restart the source when it runs out of frames')
+    parser.add_argument('--roi-only', action='store_true', help='run the image processor only on the band of the ROI')
+    parser.add_argument('--engine', default='hough', choices=('hough', 'histogram'), help='engine that finds the lanes')
+    parser.add_argument('--scale', type=int, default=1, choices=(1, 2, 4), help='process the frames at 1 / scale of their resolution')
+    parser.add_argument('--scale-method', default='pyrDown', choices=('pyrDown', 'remap'), help='reduce the undistorted frame with pyrDown or undistort directly into the reduced resolution')
+    parser.add_argument('--corridors', action='store_true', help='run the Hough transform only around the lanes predicted by the tracker')
+    parser.add_argument('--profile', action='store_true', help='report the duration of every stage of the image processor')
+    parser.add_argument('--deadline', type=float, default=None, help='adapt the quality to process a frame within this many ms')
+    parser.add_argument('--cache', action='store_true', help='cache the edges and the lane search of every frame in memory')
+    parser.add_argument('--cache-dir', default=None, help='directory where cache entries are spilled and reused between runs, implies --cache')
+    parser.add_argument('--cache-size', type=int, default=1024, help='number of cache entries kept in memory')
+    args = parser.parse_args()
+
+    profiler = StageProfiler(size=10000) if args.profile else None
+    cache = StageCache(args.cache_size, args.cache_dir) if args.cache or args.cache_dir else None
+    processor = ImageProcessor((480, 320), 20, profiler=profiler, roiOnly=args.roi_only, corridors=args.corridors, engine=args.engine, scale=args.scale, scaleMethod=args.scale_method, cache=cache)
+    source = openSource(args.source, processor.frameDimensions, processor.frameRate, loop=args.loop)
+    governor = QualityGovernor(processor, args.deadline / 1000) if args.deadline else None
+    stats = replay(source, processor, rate=args.rate, maxFrames=args.frames, governor=governor)
+
+    print('Frames: %d' % (stats['frames']))
+    if stats['frames']:
+        print('Throughput: %.1f fps' % (stats['fps']))
+        print('Latency: mean %.2f ms, p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms' % (
+            stats['mean'], stats['p50'], stats['p90'], stats['p99'], stats['max']
+        ))
+    if governor:
+        print('Quality: level %d, %d changes' % (governor.level, governor.changes))
+    if cache:
+        cache.flush()
+        print('Cache: %(hits)d hits, %(diskHits)d from disk, %(misses)d misses' % cache.stats())
+    if profiler:
+        for stage, s in profiler.stats().items():
+            print('  %-6s p50 %.2f ms, p95 %.2f ms, p99 %.2f ms' % (stage, s['p50'], s['p95'], s['p99']))
@@ -0,0 +1,343 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from processor import ImageProcessor
+from controller import Controller
+from tracker import LaneTracker
+from car import Car
+import numpy as np
+import threading
+import protocol
+import argparse
+import time
+import cv2
+import os
+
+# Average positions for the left and right lanes, the same used by main.py.
+averageLeft = np.poly1d(np.array([-3.45, 778.36]))
+averageRight = np.poly1d(np.array([3.66, -328.14]))
+
+class SceneRenderer():
+    """
+        Renders synthetic road frames with lanes at known positions. The lanes are drawn in the
+        undistorted image and then distorted with the calibration of the image processor, so that
+        the undistorted frame of the processor has the lanes exactly at the ground truth.
+    """
+
+    def __init__(self, processor, noise=8, brightness=1.0, gradient=0.3, seed=0):
+        self.w = processor.w
+        self.h = processor.h
+        self.noise = noise
+        self.brightness = brightness
+        self.gradient = gradient
+        self.random = np.random.RandomState(seed)
+
+        # For every pixel of the raw frame, find where it lies in the undistorted frame.
+        u, v = np.meshgrid(np.arange(self.w, dtype=np.float32), np.arange(self.h, dtype=np.float32))
+        points = np.stack((u.ravel(), v.ravel()), axis=1).reshape(-1, 1, 2)
+        undistorted = cv2.undistortPoints(points, processor.cameraMatrix, processor.distortionCoefficients, P=processor.newCameraMatrix)
+        self.mapX = undistorted[:, 0, 0].reshape(self.h, self.w).astype(np.float32)
+        self.mapY = undistorted[:, 0, 1].reshape(self.h, self.w).astype(np.float32)
+
+        # Static background: a brighter sky above the horizon and a road below it.
+        self.horizon = int(0.5 * self.h)
+        self.background = np.full((self.h, self.w), 90, np.float32)
+        self.background[:self.horizon] = 170
+        ramp = np.linspace(1 - self.gradient / 2, 1 + self.gradient / 2, self.w, dtype=np.float32)
+        self.background *= ramp[np.newaxis, :]
+
+    def render(self, left, right, width=6):
+        """
+            Renders a BGR frame with lanes at the polynomials left and right, given as x = f(y) in the
+            undistorted frame.
+        """
+
+        ideal = self.background.copy()
+        for poly in (left, right):
+            y0, y1 = self.horizon, self.h
+            cv2.line(ideal, (int(poly(y0)), y0), (int(poly(y1)), y1), 230, width)
+        ideal *= self.brightness
+        if self.noise:
+            ideal += self.random.normal(0, self.noise, ideal.shape).astype(np.float32)
+        raw = cv2.remap(ideal, self.mapX, self.mapY, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        return cv2.cvtColor(np.clip(raw, 0, 255).astype(np.uint8), cv2.COLOR_GRAY2BGR)
+
+class Vehicle():
+    """
+        Differential drive model of the car relative to the center of the lane. The lateral position
+        is in m, positive to the right, and the heading is in rad, positive when turning right.
+    """
+
+    def __init__(self, maxSpeed=0.5, wheelBase=0.15, lateral=0.0, heading=0.0):
+        self.maxSpeed = maxSpeed
+        self.wheelBase = wheelBase
+        self.lateral = lateral
+        self.heading = heading
+
+    def step(self, velLeft, velRight, dt):
+        """
+            Moves the vehicle dt seconds with the wheel velocities in %.
+        """
+        vl = velLeft / 100 * self.maxSpeed
+        vr = velRight / 100 * self.maxSpeed
+        v = (vl + vr) / 2
+        self.heading += (vl - vr) / self.wheelBase * dt
+        self.lateral += v * np.sin(self.heading) * dt
+
+    def lanes(self, pxPerMeter=400, lookAhead=1.0, h=320):
+        """
+            Returns the polynomials of the lanes seen from the vehicle. Moving to the right shifts the
+            lanes to the left and turning to the right shifts the far part of the lanes further.
+        """
+        # Shift in px as a linear function of the row: a + c * y.
+        c = pxPerMeter * lookAhead * np.tan(self.heading) / h
+        a = -pxPerMeter * (self.lateral + lookAhead * np.tan(self.heading))
+        shift = np.poly1d([c, a])
+        return averageLeft + shift, averageRight + shift
+
+class FakeSTM32(threading.Thread):
+    """
+        Emulates the STM32 on the master side of a pseudo terminal. Understands the same text and
+        binary commands as stm32.ino, stores the speed of the wheels and answers the status.
+        Commands with a sequence number are acknowledged with the time they were received.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.master, self.slave = os.openpty()
+        self.port = os.ttyname(self.slave)
+        self.stop = threading.Event()
+        self.parser = protocol.FrameParser()
+        self.text = b''
+        self.velLeft = 0
+        self.velRight = 0
+        self.statusInterval = 0
+        self.statusBinary = False
+        self.lastStatusTime = 0
+        self.received = []
+        self.status = (5.0, 7.4, 3.7, 3.7, 90, 85, 0)
+
+    def run(self):
+        os.set_blocking(self.master, False)
+        while not self.stop.is_set():
+            try:
+                data = os.read(self.master, 256)
+            except BlockingIOError:
+                data = b''
+            if data:
+                self.receive(data)
+            else:
+                self.stop.wait(0.001)
+            if self.statusInterval and time.monotonic() - self.lastStatusTime >= self.statusInterval / 1000:
+                self.writeStatus(self.statusBinary)
+                self.lastStatusTime = time.monotonic()
+
+    def receive(self, data):
+        """
+            Splits the data into binary frames and text commands and executes them.
+        """
+        now = time.monotonic()
+        text = bytearray()
+        for byte in data:
+            if self.parser.buffer or byte == protocol.SYNC:
+                for frameType, values in self.parser.feed(bytes((byte,))):
+                    self.execute(frameType, values, now)
+            else:
+                text.append(byte)
+        self.text += bytes(text)
+        while b'\n' in self.text:
+            line, self.text = self.text.split(b'\n', 1)
+            parts = line.decode('ascii', errors='ignore').split()
+            if len(parts) >= 3 and parts[0].upper() == 'VEL':
+                try:
+                    self.execute(protocol.VEL, (int(parts[1]), int(parts[2])), now)
+                    if len(parts) >= 4:
+                        os.write(self.master, b'ACK %d %d\n' % (int(parts[3]), self.millis(now)))
+                except ValueError:
+                    pass
+            elif parts and parts[0].upper() == 'STATUS':
+                self.writeStatus(False)
+            elif len(parts) >= 2 and parts[0].upper() == 'SUB' and parts[1].isdigit():
+                self.statusInterval = int(parts[1])
+                self.statusBinary = False
+
+    def execute(self, frameType, values, now):
+        if frameType == protocol.VEL:
+            self.velLeft, self.velRight = values
+            self.received.append((now, values))
+        elif frameType == protocol.VEL_SEQ:
+            self.execute(protocol.VEL, values[:2], now)
+            os.write(self.master, protocol.pack(protocol.ACK, values[2], self.millis(now)))
+        elif frameType == protocol.STATUS_REQUEST:
+            self.writeStatus(True)
+        elif frameType == protocol.SUBSCRIBE:
+            self.statusInterval = values[0]
+            self.statusBinary = True
+
+    def millis(self, now):
+        """
+            Time in ms like millis() on the STM32, which wraps after 49 days.
+        """
+        return int(now * 1000) & 0xFFFFFFFF
+
+    def writeStatus(self, binary):
+        if binary:
+            values = [int(v * 1000) for v in self.status[:4]] + list(self.status[4:])
+            os.write(self.master, protocol.pack(protocol.STATUS, *values))
+        else:
+            os.write(self.master, (','.join('%.2f' % v for v in self.status[:4]) + ',%d,%d,%d\n' % self.status[4:]).encode('ascii'))
+
+    def close(self):
+        self.stop.set()
+        self.join(timeout=1)
+        os.close(self.master)
+        os.close(self.slave)
+
+class Simulator():
+    """
+        Closes the loop between the synthetic frames, the real lane detection, tracking and control
+        pipeline, and a virtual car connected through a pseudo terminal.
+    """
+
+    def __init__(self, duration=20, noise=8, brightness=1.0, lateral=0.05, heading=0.0, binary=False, realtime=True, processorOptions=None):
+        self.duration = duration
+        self.realtime = realtime
+        self.processor = ImageProcessor((480, 320), 20, **(processorOptions or {}))
+        self.renderer = SceneRenderer(self.processor, noise=noise, brightness=brightness)
+        self.vehicle = Vehicle(lateral=lateral, heading=heading)
+        self.tracker = LaneTracker()
+        self.stm32 = FakeSTM32()
+        self.car = Car(self.stm32.port, 115200, keepAlive=0.5, binary=binary, statusInterval=1.0)
+        self.controller = Controller(averageLeft, averageRight, self.processor.roiY[0] * self.processor.h, car=self.car)
+        self.controller.enabled = True
+        self.controller.motors = True
+
+    def run(self):
+        """
+            Runs the simulation and returns its metrics.
+        """
+
+        self.stm32.start()
+        self.car.start()
+        processor = self.processor
+        dt = 1.0 / processor.frameRate
+        rows = (processor.roiY[0] * processor.h, processor.roiY[1] * processor.h)
+        steps = int(self.duration / dt)
+        detectionErrors = {'left': [], 'right': []}
+        missing = {'left': 0, 'right': 0}
+        lateral = np.zeros(steps)
+        processing = np.zeros(steps)
+        sent = None
+        lastCommand = None
+        latencies = []
+        received = 0
+
+        try:
+            nextTime = time.monotonic()
+            for n in range(steps):
+
+                # Render the frame as seen from the current position of the vehicle.
+                groundTruth = dict(zip(('left', 'right'), self.vehicle.lanes(h=processor.h)))
+                frame = self.renderer.render(groundTruth['left'], groundTruth['right'])
+
+                # Run the real pipeline.
+                t0 = time.monotonic()
+                processor.process(frame)
+                stamp = (n, t0, time.monotonic())
+                left, right = self.tracker.add(processor.left.poly, processor.right.poly)
+                if processor.corridors:
+                    processor.setPrediction(*self.tracker.prediction(rows))
+                self.controller.setLanes(left, right, t0, stamp)
+                if self.controller.tick():
+                    command = 'VEL %d %d' % (self.controller.velLeft, self.controller.velRight)
+                    if command != lastCommand:
+                        sent = (command, t0)
+                        lastCommand = command
+                processing[n] = time.monotonic() - t0
+
+                # Compare the detected lanes against the ground truth.
+                for name, line in (('left', processor.left), ('right', processor.right)):
+                    if line.poly is None:
+                        missing[name] += 1
+                    else:
+                        truth = groundTruth[name]
+                        detectionErrors[name].append(np.mean([abs(line.poly(y) - truth(y)) for y in rows]))
+
+                # Latency from the frame to the command reaching the car. Only the latest command is
+                # sent by the car, so only it is tracked.
+                while received < len(self.stm32.received):
+                    receiveTime, values = self.stm32.received[received]
+                    if sent and sent[0] == 'VEL %d %d' % values:
+                        latencies.append(receiveTime - sent[1])
+                        sent = None
+                    received += 1
+
+                # Move the vehicle with the wheel speeds the car received.
+                self.vehicle.step(self.stm32.velLeft, self.stm32.velRight, dt)
+                lateral[n] = self.vehicle.lateral
+
+                # Keep the frame rate.
+                if self.realtime:
+                    nextTime += dt
+                    delay = nextTime - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+        finally:
+            self.controller.stop.set()
+            self.car.shutdown()
+            self.car.join(timeout=1)
+            self.stm32.close()
+
+        return {
+            'frames': steps,
+            'leftDetectionError': float(np.mean(detectionErrors['left'])) if detectionErrors['left'] else float('nan'),
+            'rightDetectionError': float(np.mean(detectionErrors['right'])) if detectionErrors['right'] else float('nan'),
+            'leftMissing': missing['left'] / steps,
+            'rightMissing': missing['right'] / steps,
+            'lateralRms': float(np.sqrt(np.mean(lateral ** 2))),
+            'lateralMax': float(np.max(np.abs(lateral))),
+            'processing': float(np.mean(processing) * 1000),
+            'latency': float(np.mean(latencies) * 1000) if latencies else float('nan'),
+            'latencyP99': float(np.percentile(latencies, 99) * 1000) if latencies else float('nan'),
+            'glassToWheel': self.car.latency.stats(),
+            'status': self.car.status
+        }
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Closed loop simulation of the lane keeping system.')
+    parser.add_argument('--duration', type=float, default=20, help='simulated time in s')
+    parser.add_argument('--noise', type=float, default=8, help='standard deviation of the pixel noise')
+    parser.add_argument('--brightness', type=float, default=1.0, help='gain applied to the frames')
+    parser.add_argument('--lateral', type=float, default=0.05, help='initial lateral offset in m')
+    parser.add_argument('--heading', type=float, default=0.0, help='initial heading in rad')
+    parser.add_argument('--binary', action='store_true', help='use the binary protocol')
+    parser.add_argument('--fast', action='store_true', help='run as fast as possible instead of in real time')
+    parser.add_argument('--roi-only', action='store_true', help='run the image processor only on the band of the ROI')
+    parser.add_argument('--engine', default='hough', choices=('hough', 'histogram'), help='engine that finds the lanes')
+    parser.add_argument('--scale', type=int, default=1, choices=(1, 2, 4), help='process the frames at 1 / scale of their resolution')
+    parser.add_argument('--scale-method', default='pyrDown', choices=('pyrDown', 'remap'), help='reduce the undistorted frame with pyrDown or undistort directly into the reduced resolution')
+    parser.add_argument('--corridors', action='store_true', help='run the Hough transform only around the predicted lanes')
+    args = parser.parse_args()
+
+    simulator = Simulator(
+        duration=args.duration,
+        noise=args.noise,
+        brightness=args.brightness,
+        lateral=args.lateral,
+        heading=args.heading,
+        binary=args.binary,
+        realtime=not args.fast,
+        processorOptions={'roiOnly': args.roi_only, 'corridors': args.corridors, 'engine': args.engine, 'scale': args.scale, 'scaleMethod': args.scale_method}
+    )
+    results = simulator.run()
+    print('Frames: %d' % (results['frames']))
+    print('Detection error: left %.2f px, right %.2f px' % (results['leftDetectionError'], results['rightDetectionError']))
+    print('Lost lanes: left %.1f%%, right %.1f%%' % (100 * results['leftMissing'], 100 * results['rightMissing']))
+    print('Lateral error: rms %.3f m, max %.3f m' % (results['lateralRms'], results['lateralMax']))
+    print('Processing: %.2f ms per frame' % (results['processing']))
+    print('Frame to car latency: mean %.2f ms, p99 %.2f ms' % (results['latency'], results['latencyP99']))
+    for stage, s in results['glassToWheel'].items():
+        print('  %-8s p50 %.2f ms, p95 %.2f ms, p99 %.2f ms' % (stage, s['p50'], s['p95'], s['p99']))
+    print('Status: %s' % (results['status']))
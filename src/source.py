@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import threading
+import glob
+import time
+import cv2
+import os
+
+class FrameSource():
+    """
+        Base class for all frame sources. Mimics the start/read/stop interface of the
+        imutils PiVideoStream so that any source can be used in place of the camera.
+        Offline sources return None from read() once they run out of frames. Live sources deliver
+        frames at their own rate, while offline sources deliver a new frame on every read.
+    """
+
+    live = False
+
+    def __init__(self, frameDimensions):
+        self.frameDimensions = frameDimensions
+        self.w = frameDimensions[0]
+        self.h = frameDimensions[1]
+        self.sequence = 0
+
+    def start(self):
+        """
+            Starts the source. Returns itself so that it can be chained like PiVideoStream.
+        """
+        return self
+
+    def read(self):
+        """
+            Returns the next frame in BGR format or None when no more frames are available.
+        """
+        raise NotImplementedError
+
+    def readStamped(self):
+        """
+            Returns the next frame, its sequence number and the time.monotonic() when it was
+            captured. Sources without a capture time are stamped when the frame is read.
+        """
+        frame = self.read()
+        self.sequence += 1
+        return frame, self.sequence, time.monotonic()
+
+    def waitFrame(self, sequence, timeout=None):
+        """
+            Waits for a frame newer than the sequence number and returns it like readStamped(), or
+            None if the timeout in s expires. Offline sources return the next frame right away.
+        """
+        return self.readStamped()
+
+    def waitReady(self, timeout=5.0):
+        """
+            Waits until the source can deliver its first frame. Returns False if it could not within
+            the timeout in s. Offline sources are ready as soon as they are started.
+        """
+        return True
+
+    def stop(self):
+        """
+            Releases any resources held by the source.
+        """
+        pass
+
+    def prepare(self, frame):
+        """
+            Makes sure a frame is a 3 channel BGR image with the dimensions of the source.
+        """
+        if frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        if frame.shape[1] != self.w or frame.shape[0] != self.h:
+            frame = cv2.resize(frame, self.frameDimensions, interpolation=cv2.INTER_AREA)
+        return frame
+
+class CameraSource(FrameSource):
+    """
+        Threaded RPi camera. The imutils module is only imported when the camera is
+        started, which allows the offline sources to be used on machines without a camera.
+        Every frame is stamped by the capture thread as soon as it arrives, so the stamp
+        includes the time the frame waited to be read.
+    """
+
+    live = True
+
+    def __init__(self, frameDimensions, frameRate):
+        FrameSource.__init__(self, frameDimensions)
+        self.frameRate = frameRate
+        self.stream = None
+
+    def start(self):
+        from imutils.video.pivideostream import PiVideoStream
+
+        class StampedStream(PiVideoStream):
+            """
+                PiVideoStream that keeps the sequence number and capture time of its frame.
+            """
+
+            stamped = (None, 0, 0.0)
+            ready = threading.Event()
+            arrived = threading.Condition()
+
+            def update(self):
+                for f in self.stream:
+                    self.frame = f.array
+                    with self.arrived:
+                        self.stamped = (self.frame, self.stamped[1] + 1, time.monotonic())
+                        self.arrived.notify_all()
+                    self.ready.set()
+                    self.rawCapture.truncate(0)
+                    if self.stopped:
+                        self.stream.close()
+                        self.rawCapture.close()
+                        self.camera.close()
+                        return
+
+        self.stream = StampedStream(resolution=self.frameDimensions, framerate=self.frameRate).start()
+        return self
+
+    def read(self):
+        return self.stream.read()
+
+    def readStamped(self):
+        return self.stream.stamped
+
+    def waitFrame(self, sequence, timeout=None):
+        stream = self.stream
+        with stream.arrived:
+            stream.arrived.wait_for(lambda: stream.stamped[1] != sequence, timeout)
+            stamped = stream.stamped
+        return stamped if stamped[1] != sequence else None
+
+    def waitReady(self, timeout=5.0):
+        return self.stream.ready.wait(timeout)
+
+    def stop(self):
+        if self.stream:
+            self.stream.stop()
+
+class VideoFileSource(FrameSource):
+    """
+        Reads the frames from a video file (or any other format supported by cv2.VideoCapture).
+    """
+
+    def __init__(self, path, frameDimensions, loop=False):
+        FrameSource.__init__(self, frameDimensions)
+        self.path = path
+        self.loop = loop
+        self.capture = None
+
+    def start(self):
+        self.capture = cv2.VideoCapture(self.path)
+        if not self.capture.isOpened():
+            raise IOError('video file cant be opened: %s' % (self.path))
+        return self
+
+    def read(self):
+        ok, frame = self.capture.read()
+        if not ok and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self.capture.read()
+        if not ok:
+            return None
+        return self.prepare(frame)
+
+    def stop(self):
+        if self.capture:
+            self.capture.release()
+
+class ImageDirectorySource(FrameSource):
+    """
+        Reads the images of a directory in alphabetical order.
+    """
+
+    extensions = ('.png', '.jpg', '.jpeg', '.bmp')
+
+    def __init__(self, path, frameDimensions, loop=False):
+        FrameSource.__init__(self, frameDimensions)
+        self.path = path
+        self.loop = loop
+        self.files = sorted(f for f in glob.glob(os.path.join(path, '*')) if f.lower().endswith(self.extensions))
+        self.index = 0
+
+    def read(self):
+        if self.index >= len(self.files):
+            if not self.loop or len(self.files) == 0:
+                return None
+            self.index = 0
+        frame = cv2.imread(self.files[self.index])
+        self.index += 1
+        return self.prepare(frame)
+
+class NumpyStackSource(FrameSource):
+    """
+        Reads the frames from a .npy file with shape (N, h, w, 3) or (N, h, w). The file is
+        memory mapped so that large recordings don't have to fit in memory.
+    """
+
+    def __init__(self, path, frameDimensions, loop=False):
+        FrameSource.__init__(self, frameDimensions)
+        self.path = path
+        self.loop = loop
+        self.frames = np.load(path, mmap_mode='r')
+        self.index = 0
+
+    def read(self):
+        if self.index >= len(self.frames):
+            if not self.loop or len(self.frames) == 0:
+                return None
+            self.index = 0
+        frame = np.array(self.frames[self.index])
+        self.index += 1
+        return self.prepare(frame)
+
+def openSource(path, frameDimensions, frameRate, loop=False):
+    """
+        Creates the frame source for a path. Directories are read as images, .npy files as frame
+        stacks and any other file as a video. When no path is given the RPi camera is used.
+    """
+
+    if path is None:
+        return CameraSource(frameDimensions, frameRate)
+    elif os.path.isdir(path):
+        return ImageDirectorySource(path, frameDimensions, loop)
+    elif path.lower().endswith('.npy'):
+        return NumpyStackSource(path, frameDimensions, loop)
+    else:
+        return VideoFileSource(path, frameDimensions, loop)
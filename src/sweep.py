@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ProcessPoolExecutor
+from processor import ImageProcessor
+from source import openSource
+from engines import ENGINES
+from cache import StageCache
+import numpy as np
+import itertools
+import argparse
+import json
+import time
+import os
+
+# Default values of every swept setting of the ImageProcessor. The full grid has 576 configurations,
+# use --random for a quick sample.
+GRID = {
+    'blurIterations': [1, 2, 3],
+    'blurKernelSize': [5, 7],
+    'cannyThresholds': [(20, 40), (40, 80)],
+    'houghThreshold': [10, 20, 30],
+    'houghMaxLineGap': [20, 60],
+    'roiX': [(0.67, 0.95), (0.6, 1.0)],
+    'roiY': [(0.57, 0.71), (0.55, 0.75)],
+    'minAngle': [10, 20]
+}
+
+# State of every worker process: its image processor, the default value of every setting that was
+# changed, the frames of every recording and the rows where the jitter is measured.
+processor = None
+defaults = {}
+recordings = None
+rows = None
+
+def configurations(grid, samples=None, seed=0):
+    """
+        Returns the configurations of a grid, a dictionary with the values of every setting. With
+        samples, only that many random configurations are returned.
+    """
+
+    names = sorted(grid)
+    if samples is None:
+        return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+    random = np.random.RandomState(seed)
+    return [{name: grid[name][random.randint(len(grid[name]))] for name in names} for i in range(samples)]
+
+def load(paths, frameDimensions, frameRate, maxFrames=None):
+    """
+        Reads the frames of every recording.
+    """
+
+    frames = []
+    for path in paths:
+        source = openSource(path, frameDimensions, frameRate).start()
+        video = []
+        while maxFrames is None or len(video) < maxFrames:
+            frame = source.read()
+            if frame is None:
+                break
+            video.append(frame)
+        source.stop()
+        frames.append(video)
+    return frames
+
+def initialize(paths, frameDimensions, frameRate, maxFrames, cacheSize=None, cacheDirectory=None):
+    """
+        Creates the image processor of a worker process and loads the recordings once. With a cache,
+        configurations that only differ in later stages reuse the edges and lane searches.
+    """
+
+    global processor, recordings, rows
+    cache = StageCache(cacheSize, cacheDirectory) if cacheSize else None
+    processor = ImageProcessor(frameDimensions, frameRate, cache=cache)
+    recordings = load(paths, frameDimensions, frameRate, maxFrames)
+
+    # The jitter is measured at the top and bottom rows of the default ROI, so that configurations
+    # with another roiY are scored at the same rows.
+    rows = (processor.h * processor.roiY[0], processor.h * processor.roiY[1])
+
+def evaluate(config, setup):
+    """
+        Runs all recordings through the image processor with a configuration. Returns its scores: the
+        mean frame to frame change of the lanes at the top and bottom rows of the default ROI (jitter) in px,
+        the fraction of lanes that were not found (lost) and the CPU time per frame in ms. setup holds
+        the arguments of initialize(), which is called by the first evaluation in a worker process
+        (the initializer of ProcessPoolExecutor needs Python 3.7).
+    """
+
+    if processor is None:
+        initialize(*setup)
+
+    # Settings that are not part of the configuration keep their default value.
+    settings = dict(config)
+    processor.engine = ENGINES[settings.pop('engine', 'hough')](processor)
+    for name in settings:
+        defaults.setdefault(name, getattr(processor, name))
+    processor.setQuality(**dict(defaults, **settings))
+
+    changes = []
+    lost = 0
+    count = 0
+    cpu = 0
+    for video in recordings:
+        previous = [None, None]
+        for frame in video:
+            t0 = time.process_time()
+            processor.process(frame)
+            cpu += time.process_time() - t0
+            count += 1
+            for lane, line in enumerate((processor.left, processor.right)):
+                if line.poly is None:
+                    lost += 1
+                    previous[lane] = None
+                    continue
+                x = line.poly(rows)
+                if previous[lane] is not None:
+                    changes.append(np.mean(np.abs(x - previous[lane])))
+                previous[lane] = x
+
+    # The entries are spilled after every configuration so that the other workers can use them.
+    if processor.cache:
+        processor.cache.flush()
+    return {
+        'config': config,
+        'frames': count,
+        'jitter': float(np.mean(changes)) if changes else np.inf,
+        'lost': lost / (2 * count) if count else 1.0,
+        'cpu': cpu / count * 1000 if count else np.inf
+    }
+
+def rank(results, maxLost=0.1, maxJitter=10):
+    """
+        Sorts the results with the configurations that stay accurate first and by their CPU time.
+    """
+
+    for result in results:
+        result['accurate'] = result['lost'] <= maxLost and result['jitter'] <= maxJitter
+    return sorted(results, key=lambda result: (not result['accurate'], result['cpu'], result['jitter']))
+
+def sweep(paths, configs, workers=None, frameDimensions=(480, 320), frameRate=20, maxFrames=None, cacheSize=None, cacheDirectory=None):
+    """
+        Evaluates every configuration on the recordings with a pool of worker processes.
+    """
+
+    setup = (paths, frameDimensions, frameRate, maxFrames, cacheSize, cacheDirectory)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(evaluate, configs, itertools.repeat(setup)))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Evaluates ImageProcessor configurations on recordings.')
+    parser.add_argument('recordings', help='directory with the recorded videos or a single recording')
+    parser.add_argument('--grid', default=None, help='JSON file with the values of every setting, default is GRID')
+    parser.add_argument('--random', type=int, default=None, help='evaluate this many random configurations of the grid')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random configurations')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes, default is the number of CPUs')
+    parser.add_argument('--frames', type=int, default=None, help='maximum number of frames of every recording')
+    parser.add_argument('--max-lost', type=float, default=0.1, help='maximum fraction of lost lanes of an accurate configuration')
+    parser.add_argument('--max-jitter', type=float, default=10, help='maximum jitter in px of an accurate configuration')
+    parser.add_argument('--top', type=int, default=20, help='number of configurations printed')
+    parser.add_argument('--cache-size', type=int, default=None, help='cache this many edge maps and lane searches in memory per worker')
+    parser.add_argument('--cache-dir', default=None, help='directory where cache entries are shared between workers and runs, implies --cache-size 1024')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.recordings):
+        paths = [os.path.join(args.recordings, name) for name in sorted(os.listdir(args.recordings))]
+    else:
+        paths = [args.recordings]
+    grid = GRID
+    if args.grid:
+        with open(args.grid) as f:
+            grid = {name: [tuple(value) if isinstance(value, list) else value for value in values] for name, values in json.load(f).items()}
+    configs = configurations(grid, args.random, args.seed)
+
+    print('Evaluating %d configurations on %d recordings' % (len(configs), len(paths)))
+    t0 = time.time()
+    cacheSize = args.cache_size or (1024 if args.cache_dir else None)
+    results = rank(sweep(paths, configs, args.workers, maxFrames=args.frames, cacheSize=cacheSize, cacheDirectory=args.cache_dir), args.max_lost, args.max_jitter)
+    print('Done in %.1f s' % (time.time() - t0))
+    if cacheSize:
+        print('The CPU times include cache hits and only compare configurations evaluated with the same cache state')
+
+    print('%4s %8s %10s %7s %3s  %s' % ('rank', 'cpu ms', 'jitter px', 'lost %', 'ok', 'configuration'))
+    for n, result in enumerate(results[:args.top]):
+        print('%4d %8.2f %10.2f %7.1f %3s  %s' % (
+            n + 1, result['cpu'], result['jitter'], 100 * result['lost'], 'yes' if result['accurate'] else 'no',
+            ', '.join('%s=%s' % (name, value) for name, value in sorted(result['config'].items()))
+        ))
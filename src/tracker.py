@@ -6,19 +6,31 @@
     https://share.cocalc.com/share/7557a5ac1c870f1ec8f01271959b16b49df9d087/Kalman-and-Bayesian-Filters-in-Python/08-Designing-Kalman-Filters.ipynb?viewer=share
 """
 
-from filterpy.common import Q_discrete_white_noise
-from filterpy.kalman import KalmanFilter
-from scipy.linalg import block_diag
 import numpy as np
 import cv2
 
+def quantizeDt(dt, resolution=1e-3, maxDt=1.0):
+    """
+        Rounds the time between updates to a multiple of the resolution, so that the models of close
+        values are shared, and limits it to (resolution, maxDt), e.g. after the program was paused.
+    """
+    return min(max(round(dt / resolution), 1) * resolution, maxDt)
+
 class Tracker():
     """
-        Tracker class implements a 1-D Kalman filter for a line.
+        Tracker class implements a 1-D Kalman filter for a line. The time between updates can be
+        passed to every update, in which case F and Q are rebuilt for it. The matrices of the last
+        few values are cached, since the time between frames only takes a few values.
     """
 
-    def __init__(self, dt=1.0/20.0):
-    
+    def __init__(self, dt=1.0/20.0, maxModels=8):
+
+        # FilterPy and SciPy take about a second to import on the RPi, so they are only imported by
+        # this reference implementation and not by LaneTracker.
+        from filterpy.common import Q_discrete_white_noise
+        from filterpy.kalman import KalmanFilter
+        from scipy.linalg import block_diag
+
         # Defines the time between updates. It is used for the discrete white noise. 
         self.dt = dt
 
@@ -49,7 +61,6 @@ class Tracker():
         processVariance = 30
         q = Q_discrete_white_noise(dim=2, dt=self.dt, var=processVariance)
         self.kalman.Q = block_diag(q, q)
-        print(self.kalman.Q)
         
         # R : ndarray (dim_z, dim_z), default eye(dim_x)
         #     measurement uncertainty/noise
@@ -77,13 +88,46 @@ class Tracker():
         # B : ndarray (dim_x, dim_u), default 0
         #     control transition matrix 
 
+        # F and Q of recent values of dt, the most recently used last.
+        self.processVariance = processVariance
+        self.maxModels = maxModels
+        self.models = {dt: (self.kalman.F, self.kalman.Q)}
 
-    def add(self, poly):
+    def setDt(self, dt):
+        """
+            Sets the time between updates and the F and Q matrices for it.
+        """
+        from filterpy.common import Q_discrete_white_noise
+        from scipy.linalg import block_diag
+
+        dt = quantizeDt(dt)
+        if dt == self.dt:
+            return
+        model = self.models.pop(dt, None)
+        if model is None:
+            F = np.array([
+                [1, dt, 0, 0],
+                [0, 1, 0, 0],
+                [0, 0, 1, dt],
+                [0, 0, 0, 1]
+            ])
+            q = Q_discrete_white_noise(dim=2, dt=dt, var=self.processVariance)
+            model = (F, block_diag(q, q))
+        self.models[dt] = model
+        while len(self.models) > self.maxModels:
+            del self.models[next(iter(self.models))]
+        self.kalman.F, self.kalman.Q = model
+        self.dt = dt
+
+    def add(self, poly, dt=None):
         """
             Updates the kalman filter with the measured polynomial and returns the filtered polynomial.
+            dt is the time since the previous update, by default the one given to the constructor.
         """
 
         # Predict where the line should be.
+        if dt is not None:
+            self.setDt(dt)
         self.kalman.predict()
         
         # Update the kalman filter with the measured slope and -x intercept.
@@ -98,4 +142,218 @@ class Tracker():
 
         # Return filtered polynomial.
         line = np.poly1d([self.kalman.x[0, 0], self.kalman.x[2, 0]])
-        return line
\ No newline at end of file
+        return line
+
+class LaneTracker():
+    """
+        Specialized Kalman filter for both lanes. It implements the same constant velocity model as the
+        Tracker class, but since H, F, Q and R are fixed and block diagonal, the slope and intercept of
+        each lane are tracked as four independent 2-D filters that are updated together with closed
+        form 2x2 equations on preallocated arrays. Optionally the precomputed steady state gain is used
+        instead of propagating the covariance. Like Tracker, it accepts the time between updates and
+        caches the noise (and the steady state covariance) of the last few values.
+    """
+
+    def __init__(self, dt=1.0/20.0, processVariance=30, measurementVariance=0.5, uncertaintyInit=500, steadyState=False, maxModels=8):
+
+        # Defines the time between updates and the noise of the model.
+        self.dt = dt
+        self.processVariance = processVariance
+        self.q = processVariance * np.array([dt**4 / 4, dt**3 / 2, dt**2])
+        self.r = measurementVariance
+        self.maxModels = maxModels
+        self.models = {}
+
+        # State of the filters: slope and intercept of the left lane followed by the right lane.
+        # Each filter holds a value and its rate of change.
+        self.x = np.zeros((4, 2))
+
+        # Covariance of each filter as [p00, p01, p11].
+        self.P = np.zeros((4, 3))
+        self.P[:, 0] = uncertaintyInit
+        self.P[:, 2] = uncertaintyInit
+
+        # Preallocated buffers for the update.
+        self.z = np.zeros(4)
+        self.mask = np.zeros(4)
+        self.k0 = np.zeros(4)
+        self.k1 = np.zeros(4)
+        self.residual = np.zeros(4)
+
+        # Steady state gain.
+        self.steadyState = steadyState
+        if steadyState:
+            self.P[:] = self.steadyStateCovariance()
+        self.models[dt] = (self.q, self.P[0].copy() if steadyState else None)
+
+    def steadyStateCovariance(self, iterations=10000, tolerance=1e-12):
+        """
+            Iterates the predict and update equations of the covariance until it converges. Returns the
+            covariance after the prediction step, which is the one used for calculating the gain.
+        """
+
+        p00, p01, p11 = self.P[0]
+        dt = self.dt
+        for i in range(iterations):
+            a = p00 + dt * (2 * p01 + dt * p11) + self.q[0]
+            b = p01 + dt * p11 + self.q[1]
+            c = p11 + self.q[2]
+            s = a + self.r
+            n00, n01, n11 = a - a * a / s, b - a * b / s, c - b * b / s
+            converged = abs(n00 - p00) + abs(n01 - p01) + abs(n11 - p11) < tolerance
+            p00, p01, p11 = n00, n01, n11
+            if converged:
+                break
+        return np.array([a, b, c])
+
+    def setDt(self, dt):
+        """
+            Sets the time between updates and the process noise for it. With the steady state gain
+            the covariance is the steady state one of that dt.
+        """
+
+        dt = quantizeDt(dt)
+        if dt == self.dt:
+            return
+        model = self.models.pop(dt, None)
+        self.dt = dt
+        if model is None:
+            self.q = self.processVariance * np.array([dt**4 / 4, dt**3 / 2, dt**2])
+            model = (self.q, self.steadyStateCovariance() if self.steadyState else None)
+        self.models[dt] = model
+        while len(self.models) > self.maxModels:
+            del self.models[next(iter(self.models))]
+        self.q, covariance = model
+        if covariance is not None:
+            self.P[:] = covariance
+
+    def predict(self):
+        """
+            Predicts the state and covariance of all filters.
+        """
+
+        x, P, dt = self.x, self.P, self.dt
+        x[:, 0] += dt * x[:, 1]
+        if not self.steadyState:
+            P[:, 0] += dt * (2 * P[:, 1] + dt * P[:, 2]) + self.q[0]
+            P[:, 1] += dt * P[:, 2] + self.q[1]
+            P[:, 2] += self.q[2]
+
+    def update(self):
+        """
+            Updates the filters with the measurements in z. Filters with a mask of 0 are not updated.
+        """
+
+        x, P = self.x, self.P
+        k0, k1, residual = self.k0, self.k1, self.residual
+
+        # Kalman gain for H = [1, 0].
+        np.add(P[:, 0], self.r, out=k1)
+        np.divide(self.mask, k1, out=k1)
+        np.multiply(P[:, 0], k1, out=k0)
+        np.multiply(P[:, 1], k1, out=k1)
+
+        # Update the state with the residual.
+        np.subtract(self.z, x[:, 0], out=residual)
+        x[:, 0] += k0 * residual
+        x[:, 1] += k1 * residual
+
+        # Update the covariance with P = (I - KH)P.
+        if not self.steadyState:
+            P[:, 2] -= k1 * P[:, 1]
+            P[:, 1] -= k0 * P[:, 1]
+            P[:, 0] -= k0 * P[:, 0]
+
+    def prediction(self, y):
+        """
+            Returns the predicted polynomials of both lanes for the next update and the standard
+            deviation of their -x position at the rows y. Since the slope and intercept are filtered
+            independently, their covariance is ignored and the deviation is an upper bound.
+        """
+
+        x, P, dt = self.x, self.P, self.dt
+        predicted = x[:, 0] + dt * x[:, 1]
+        if self.steadyState:
+            variance = P[:, 0]
+        else:
+            variance = P[:, 0] + dt * (2 * P[:, 1] + dt * P[:, 2]) + self.q[0]
+        y = np.asarray(y, dtype=float)
+        leftSigma = np.sqrt(y * y * variance[0] + variance[1])
+        rightSigma = np.sqrt(y * y * variance[2] + variance[3])
+        return np.poly1d(predicted[0:2]), np.poly1d(predicted[2:4]), leftSigma, rightSigma
+
+    def add(self, leftPoly, rightPoly, dt=None):
+        """
+            Updates the filters with the measured polynomials of both lanes and returns the filtered
+            polynomials. A lane that was not found is None and its filters are only predicted. dt is
+            the time since the previous update, by default the one given to the constructor.
+        """
+
+        if dt is not None:
+            self.setDt(dt)
+        self.predict()
+        for i, poly in ((0, leftPoly), (2, rightPoly)):
+            if poly:
+                self.z[i] = poly.coeffs[0]
+                self.z[i + 1] = poly.coeffs[1]
+                self.mask[i] = self.mask[i + 1] = 1
+            else:
+                self.mask[i] = self.mask[i + 1] = 0
+        self.update()
+
+        # poly1d keeps the array it gets, so the state is copied to not change the returned
+        # polynomials while another thread still uses them.
+        return np.poly1d(self.x[0:2, 0].copy()), np.poly1d(self.x[2:4, 0].copy())
+
+if __name__ == '__main__':
+
+    """
+        Small test that checks that the LaneTracker gives the same result as two Tracker instances and
+        compares their speed.
+    """
+    import time
+
+    # Random measurements around the average lanes with some missing lanes.
+    random = np.random.RandomState(0)
+    measurements = []
+    for i in range(500):
+        left = np.poly1d([-3.45 + random.normal(0, 0.3), 778.36 + random.normal(0, 30)])
+        right = np.poly1d([3.66 + random.normal(0, 0.3), -328.14 + random.normal(0, 30)])
+        measurements.append((left if random.rand() > 0.1 else None, right if random.rand() > 0.1 else None))
+
+    # Compare the output of both implementations, at the fixed dt and at a variable one.
+    dts = random.choice((0.033, 0.05, 0.067, 0.1), len(measurements))
+    for name, times in (('fixed dt', [None] * len(measurements)), ('variable dt', dts)):
+        leftTracker, rightTracker = Tracker(), Tracker()
+        laneTracker = LaneTracker()
+        maxError = 0
+        first = None
+        for (left, right), dt in zip(measurements, times):
+            expected = (leftTracker.add(left, dt), rightTracker.add(right, dt))
+            result = laneTracker.add(left, right, dt)
+            for e, r in zip(expected, result):
+                maxError = max(maxError, np.max(np.abs(e.coeffs - r.coeffs) / (np.abs(e.coeffs) + 1)))
+            if first is None:
+                first = result
+                firstCoeffs = [poly.coeffs.copy() for poly in result]
+        print('Maximum relative difference, %s: %.2e' % (name, maxError))
+        assert maxError < 1e-5, 'LaneTracker differs from Tracker'
+
+        # A returned polynomial must not change with the later updates.
+        for poly, coeffs in zip(first, firstCoeffs):
+            assert np.array_equal(poly.coeffs, coeffs), 'LaneTracker changed a returned polynomial'
+
+    # Compare the speed of both implementations.
+    for name, trackers in (
+        ('Tracker', (Tracker(), Tracker())),
+        ('LaneTracker', LaneTracker()),
+        ('LaneTracker steady state', LaneTracker(steadyState=True))
+    ):
+        t0 = time.perf_counter()
+        for left, right in measurements:
+            if isinstance(trackers, tuple):
+                trackers[0].add(left)
+                trackers[1].add(right)
+            else:
+                trackers.add(left, right)
+        print('%s: %.1f us per frame' % (name, (time.perf_counter() - t0) / len(measurements) * 1e6))
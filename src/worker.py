@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from multiprocessing import shared_memory
+from processor import ImageProcessor
+import multiprocessing
+import numpy as np
+import queue
+import time
+
+def work(memoryName, shape, frameRate, options, tasks, results):
+    """
+        Main function of a worker process. Attaches to the shared frame ring, processes the slots it
+        receives through the tasks queue and sends back only the coefficients of the fitted lanes.
+        The output frame is never sent back, so the segments are not drawn.
+    """
+
+    memory = shared_memory.SharedMemory(name=memoryName)
+    frames = np.ndarray(shape, np.uint8, buffer=memory.buf)
+    processor = ImageProcessor((shape[2], shape[1]), frameRate, **options)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, sequence = task
+        t0 = time.perf_counter()
+        processor.process(frames[slot], draw=False)
+        duration = time.perf_counter() - t0
+        results.put((
+            slot,
+            sequence,
+            None if processor.left.poly is None else tuple(processor.left.poly.coeffs),
+            None if processor.right.poly is None else tuple(processor.right.poly.coeffs),
+            duration
+        ))
+
+    del frames
+    memory.close()
+
+class VisionPool():
+    """
+        Runs the ImageProcessor in one or more worker processes. Frames are written into a ring of
+        preallocated slots in shared memory, so that they are never pickled, and only the coefficients
+        of the fitted lanes come back. When all slots are busy new frames are dropped.
+    """
+
+    def __init__(self, frameDimensions, frameRate, workers=2, slots=None, options=None):
+        self.frameDimensions = frameDimensions
+        self.workers = workers
+        self.slots = slots or 2 * workers
+        self.shape = (self.slots, frameDimensions[1], frameDimensions[0], 3)
+        self.memory = shared_memory.SharedMemory(create=True, size=int(np.prod(self.shape)))
+        self.frames = np.ndarray(self.shape, np.uint8, buffer=self.memory.buf)
+        self.free = list(range(self.slots))
+        self.contexts = [None] * self.slots
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.sequence = 0
+        self.lastSequence = 0
+        self.submitted = 0
+        self.dropped = 0
+        self.stale = 0
+        self.processes = [
+            multiprocessing.Process(
+                target=work,
+                args=(self.memory.name, self.shape, frameRate, options or {}, self.tasks, self.results),
+                daemon=True
+            ) for i in range(workers)
+        ]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        return self
+
+    def submit(self, frame, context=None):
+        """
+            Copies a frame into a free slot and queues it for processing. The context is kept in this
+            process and returned together with the result. Returns the sequence number of the frame or
+            None if it was dropped because all slots are busy.
+        """
+        if not self.free:
+            self.dropped += 1
+            return None
+        slot = self.free.pop()
+        self.frames[slot][:] = frame
+        self.contexts[slot] = context
+        self.sequence += 1
+        self.submitted += 1
+        self.tasks.put((slot, self.sequence))
+        return self.sequence
+
+    def collect(self, timeout=None):
+        """
+            Waits for the next result and frees its slot. Results older than the last one returned are
+            discarded. Returns (sequence, leftPoly, rightPoly, duration, context) or None on timeout.
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            try:
+                remaining = None if deadline is None else max(deadline - time.perf_counter(), 0)
+                slot, sequence, left, right, duration = self.results.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            context = self.contexts[slot]
+            self.contexts[slot] = None
+            self.free.append(slot)
+            if sequence < self.lastSequence:
+                self.stale += 1
+                continue
+            self.lastSequence = sequence
+            return (
+                sequence,
+                None if left is None else np.poly1d(left),
+                None if right is None else np.poly1d(right),
+                duration,
+                context
+            )
+
+    def stop(self):
+        """
+            Stops the workers and releases the shared memory.
+        """
+        for process in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=2)
+            if process.is_alive():
+                process.terminate()
+        del self.frames
+        self.memory.close()
+        self.memory.unlink()
+
+if __name__ == '__main__':
+
+    """
+        Small test that compares the throughput of the pool against a single in-process processor
+        with random frames.
+    """
+    frameDimensions = (480, 320)
+    frames = np.random.randint(0, 255, (40, frameDimensions[1], frameDimensions[0], 3), np.uint8)
+
+    processor = ImageProcessor(frameDimensions, 20)
+    t0 = time.perf_counter()
+    for frame in frames:
+        processor.process(frame)
+    print('In process: %.1f fps' % (len(frames) / (time.perf_counter() - t0)))
+
+    for workers in (1, 2, 4):
+        pool = VisionPool(frameDimensions, 20, workers=workers).start()
+        t0 = time.perf_counter()
+        collected = 0
+        for frame in frames:
+            while pool.submit(frame) is None:
+                if pool.collect(timeout=1):
+                    collected += 1
+        while len(pool.free) < pool.slots and pool.collect(timeout=1):
+            collected += 1
+        print('%d workers: %.1f fps' % (workers, collected / (time.perf_counter() - t0)))
+        pool.stop()
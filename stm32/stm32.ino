@@ -22,6 +22,18 @@
 #define PIN_MOTOR_BATTERY           PA1
 #define PIN_MOTOR_BATTERY_1C        PA0
 #define STM32_VOLTAGE 3.318
+#define FRAME_SYNC                  0xAA
+#define FRAME_VEL                   0x01
+#define FRAME_STATUS_REQUEST        0x02
+#define FRAME_SUBSCRIBE             0x03
+#define FRAME_VEL_SEQ               0x04
+#define FRAME_STATUS                0x82
+#define FRAME_ACK                   0x84
+#define FRAME_MAX_PAYLOAD           16
+#define FRAME_IDLE                  0
+#define FRAME_TYPE                  1
+#define FRAME_PAYLOAD               2
+#define FRAME_CHECKSUM              3
 
 const float RPI_BATTERY_FACTOR      = (STM32_VOLTAGE / 4095.0) / (47.0 / (22.0 + 47.0));
 const float MOTOR_BATTERY_FACTOR    = (STM32_VOLTAGE / 4095.0) / (21.86 / (21.86 + 46.7));
@@ -38,6 +50,7 @@ CircularBuffer<float, 10> motorBatteryCell1VoltageBuffer;
 
 char in;
 String command, instruction, data1, data2;
+unsigned long receivedTime;
 boolean shutdownFlag, buttonFlag, connectedFlag, beepFlag;
 unsigned long lastCommandTime, beepStartTime;
 unsigned long lastBatteryWarningTime;
@@ -45,6 +58,13 @@ unsigned long lastButtonPressTime;
 unsigned long beepDuration;
 int beepRepetitions = 0;
 int buttonCount = 0;
+int frameState = FRAME_IDLE;
+int frameLength, frameIndex;
+byte frameType, frameChecksum;
+byte framePayload[FRAME_MAX_PAYLOAD];
+unsigned long statusInterval = 0;
+unsigned long lastStatusTime;
+boolean statusBinary;
 
 void setup() {
   Serial.begin(115200);
@@ -151,14 +171,173 @@ void asyncBeep() {
   
 }
 
+int frameLengthFor(byte type) {
+  switch (type) {
+    case FRAME_VEL: return 2;
+    case FRAME_STATUS_REQUEST: return 0;
+    case FRAME_SUBSCRIBE: return 2;
+    case FRAME_VEL_SEQ: return 4;
+    default: return -1;
+  }
+}
+
+boolean readFrame(byte b) {
+
+  // Binary frames are SYNC | TYPE | PAYLOAD | CHECKSUM where the checksum is the XOR
+  // of the type and the payload. Returns true once a valid frame was received.
+  switch (frameState) {
+    case FRAME_IDLE:
+      frameState = FRAME_TYPE;
+      break;
+    case FRAME_TYPE:
+      frameType = b;
+      frameLength = frameLengthFor(b);
+      frameChecksum = b;
+      frameIndex = 0;
+      if (frameLength < 0) {
+        frameState = FRAME_IDLE;
+      } else if (frameLength == 0) {
+        frameState = FRAME_CHECKSUM;
+      } else {
+        frameState = FRAME_PAYLOAD;
+      }
+      break;
+    case FRAME_PAYLOAD:
+      framePayload[frameIndex++] = b;
+      frameChecksum ^= b;
+      if (frameIndex >= frameLength) {
+        frameState = FRAME_CHECKSUM;
+      }
+      break;
+    case FRAME_CHECKSUM:
+      frameState = FRAME_IDLE;
+      return b == frameChecksum;
+  }
+  return false;
+  
+}
+
+void writeFrame(byte type, byte *payload, int length) {
+  byte checksum = type;
+  Serial.write(FRAME_SYNC);
+  Serial.write(type);
+  for (int i = 0; i < length; i++) {
+    Serial.write(payload[i]);
+    checksum ^= payload[i];
+  }
+  Serial.write(checksum);
+}
+
+void writeMillivolts(byte *payload, float voltage) {
+  unsigned int mv = voltage * 1000;
+  payload[0] = mv & 0xFF;
+  payload[1] = mv >> 8;
+}
+
+void writeStatusFrame() {
+  byte payload[11];
+  writeMillivolts(payload, rpiBatteryVoltage);
+  writeMillivolts(payload + 2, motorBatteryVoltage);
+  writeMillivolts(payload + 4, motorBatteryCell1Voltage);
+  writeMillivolts(payload + 6, motorBatteryCell2Voltage);
+  payload[8] = rpiBatteryCharge;
+  payload[9] = motorBatteryCharge;
+  payload[10] = shutdownFlag;
+  writeFrame(FRAME_STATUS, payload, 11);
+}
+
+void writeStatusText() {
+  Serial.print(rpiBatteryVoltage);          Serial.write(',');
+  Serial.print(motorBatteryVoltage);        Serial.write(',');
+  Serial.print(motorBatteryCell1Voltage);   Serial.write(',');
+  Serial.print(motorBatteryCell2Voltage);   Serial.write(',');
+  Serial.print(rpiBatteryCharge);           Serial.write(',');
+  Serial.print(motorBatteryCharge);         Serial.write(',');
+  Serial.print(shutdownFlag);
+  Serial.write('\n');
+}
+
+void writeAckFrame(unsigned int sequence, unsigned long time) {
+  byte payload[6];
+  payload[0] = sequence & 0xFF;
+  payload[1] = sequence >> 8;
+  for (int i = 0; i < 4; i++) {
+    payload[2 + i] = (time >> (8 * i)) & 0xFF;
+  }
+  writeFrame(FRAME_ACK, payload, 6);
+}
+
+void writeAckText(unsigned int sequence, unsigned long time) {
+
+  // Acknowledges a VEL command with its sequence number and the time it was received in ms.
+  Serial.print(F("ACK "));
+  Serial.print(sequence);
+  Serial.write(' ');
+  Serial.print(time);
+  Serial.write('\n');
+  
+}
+
+void pushStatus() {
+
+  // Sends the status periodically once the RPI subscribed to it.
+  if (statusInterval > 0 && millis() - lastStatusTime >= statusInterval) {
+    if (statusBinary) {
+      writeStatusFrame();
+    } else {
+      writeStatusText();
+    }
+    lastStatusTime = millis();
+  }
+  
+}
+
+void processFrame() {
+
+  if (frameType == FRAME_VEL) {
+    leftMotorSpeed((int8_t) framePayload[0]);
+    rightMotorSpeed((int8_t) framePayload[1]);
+  } else if (frameType == FRAME_VEL_SEQ) {
+    leftMotorSpeed((int8_t) framePayload[0]);
+    rightMotorSpeed((int8_t) framePayload[1]);
+    writeAckFrame(framePayload[2] | (framePayload[3] << 8), receivedTime);
+  } else if (frameType == FRAME_STATUS_REQUEST) {
+    writeStatusFrame();
+  } else if (frameType == FRAME_SUBSCRIBE) {
+    statusInterval = framePayload[0] | (framePayload[1] << 8);
+    statusBinary = true;
+  }
+  commandReceived();
+  
+}
+
+void commandReceived() {
+
+  if (!connectedFlag) {
+    connectedFlag = true;
+    beep(75, 1);
+  }
+  lastCommandTime = millis();
+  
+}
+
 void readCommands() {
 
   while (Serial.available()) {
     
     in = Serial.read();
+
+    // The sync byte is never part of a text command, so binary frames can be mixed with them.
+    if (frameState != FRAME_IDLE || (byte) in == FRAME_SYNC) {
+
+      if (readFrame(in)) {
+        receivedTime = millis();
+        processFrame();
+      }
+      
+    } else if (in == '\n') {
     
-    if (in == '\n') {
-    
+      receivedTime = millis();
       command += '\0';
       instruction = command.substring(0, command.indexOf(' '));
 
@@ -172,27 +351,25 @@ void readCommands() {
         }
         leftMotorSpeed(data1.toInt());
         rightMotorSpeed(data2.toInt());
+
+        // An optional sequence number after the speeds is acknowledged.
+        if (data2.indexOf(' ') > 0) {
+          writeAckText(data2.substring(data2.indexOf(' ') + 1).toInt(), receivedTime);
+        }
         
       } else if (instruction.equalsIgnoreCase(F("STATUS"))) {
 
-        Serial.print(rpiBatteryVoltage);          Serial.write(',');
-        Serial.print(motorBatteryVoltage);        Serial.write(',');
-        Serial.print(motorBatteryCell1Voltage);   Serial.write(',');
-        Serial.print(motorBatteryCell2Voltage);   Serial.write(',');
-        Serial.print(rpiBatteryCharge);           Serial.write(',');
-        Serial.print(motorBatteryCharge);         Serial.write(',');
-        Serial.print(shutdownFlag);
-        Serial.write('\n');
+        writeStatusText();
         
-      }
+      } else if (instruction.equalsIgnoreCase(F("SUB"))) {
 
-      if (!connectedFlag) {
-        connectedFlag = true;
-        beep(75, 1);
+        statusInterval = command.substring(command.indexOf(' ') + 1).toInt();
+        statusBinary = false;
+        
       }
-      
+
+      commandReceived();
       command = "";
-      lastCommandTime = millis();
       
     } else {
       
@@ -206,6 +383,7 @@ void readCommands() {
 void loop() {
   readCommands();
   readBatteries();
+  pushStatus();
   asyncBeep();
 
   buttonFlag = digitalRead(PIN_BUTTON);